@@ -3,15 +3,55 @@
 import json
 import os
 import sys
+import time
+import random
+import hashlib
+import argparse
 import asyncio
 import aiohttp
 
+SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
 def check_file_exists(file_path):
     if not os.path.isfile(file_path):
         print(f"Error: File not found - {file_path}")
         sys.exit(1)
 
-async def upload_file(session, url, file_path, file_name, file_description, debug):
+
+def file_hash(file_path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# remembers the content hash of every file we uploaded, per endpoint,
+# so re-seeding an environment only sends the files that changed
+class Manifest:
+    def __init__(self, path, endpoint):
+        self.path = path
+        self.endpoint = endpoint
+        self.entries = {}
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                self.entries = json.load(f)
+
+    def is_current(self, file_name, content_hash):
+        return self.entries.get(self.endpoint, {}).get(file_name) == content_hash
+
+    def record(self, file_name, content_hash):
+        self.entries.setdefault(self.endpoint, {})[file_name] = content_hash
+        # write to a temp file first so an interrupted run never leaves a broken manifest
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+async def upload_file(session, url, file_path, file_name, file_description, debug, retries=3, backoff=1.0):
     if debug:
         curl_command = (
             f'curl -X POST "{url}" '
@@ -20,41 +60,95 @@ async def upload_file(session, url, file_path, file_name, file_description, debu
             f'-F "file_description={file_description}"'
         )
         print(curl_command)
-    else:
-        with open(file_path, 'rb') as file_data:
-            form_data = aiohttp.FormData()
-            form_data.add_field('file_data', file_data, filename=file_name)
-            form_data.add_field('file_name', file_name)
-            form_data.add_field('file_description', file_description)
-            
-            async with session.post(url, data=form_data) as response:
-                if response.status == 200:
-                    print(f"Successfully uploaded {file_name}")
-                else:
-                    print(f"Failed to upload {file_name}: {response.status}")
-
-async def main(directory, endpoint, debug):
-    with open('baseball_databank.json', 'r') as f:
+        return True
+
+    error = None
+    for attempt in range(retries + 1):
+        try:
+            # the file is streamed from disk, reopened for every attempt
+            with open(file_path, 'rb') as file_data:
+                form_data = aiohttp.FormData()
+                form_data.add_field('file_data', file_data, filename=file_name)
+                form_data.add_field('file_name', file_name)
+                form_data.add_field('file_description', file_description)
+
+                async with session.post(url, data=form_data) as response:
+                    if response.status == 200:
+                        return True
+                    error = f"HTTP {response.status}: {(await response.text()).strip()}"
+                    if response.status not in RETRY_STATUS_CODES:
+                        break
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error = str(e) or type(e).__name__
+        if attempt < retries:
+            delay = backoff * 2 ** attempt + random.uniform(0, backoff)
+            print(f"Retrying {file_name} in {delay:.1f}s ({error})")
+            await asyncio.sleep(delay)
+    print(f"Failed to upload {file_name}: {error}")
+    return False
+
+
+async def main(args):
+    with open(args.metadata, 'r') as f:
         data_blocks = json.load(f)
-    
-    async with aiohttp.ClientSession() as session:
-        tasks = []
-        for block in data_blocks:
-            file_name = block['file_name']
-            file_path = os.path.join(directory, file_name)
-            check_file_exists(file_path)  # Check if the file exists
-            file_description = block['file_description']
-            tasks.append(upload_file(session, endpoint, file_path, file_name, file_description, debug))
-        
-        await asyncio.gather(*tasks)
+    manifest = Manifest(args.manifest, args.endpoint)
+
+    # figure out what actually needs to be uploaded before we start
+    uploads = []
+    for block in data_blocks:
+        file_name = block['file_name']
+        file_path = os.path.join(args.directory, file_name)
+        check_file_exists(file_path)  # Check if the file exists
+        content_hash = file_hash(file_path)
+        if not args.force and not args.debug and manifest.is_current(file_name, content_hash):
+            print(f"Skipping {file_name}, unchanged since the last upload")
+            continue
+        uploads.append((file_name, file_path, block['file_description'], content_hash))
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    progress = {"done": 0, "failed": 0}
+    start = time.perf_counter()
+
+    async def upload(session, file_name, file_path, file_description, content_hash):
+        async with semaphore:
+            upload_start = time.perf_counter()
+            ok = await upload_file(session, args.endpoint, file_path, file_name, file_description, args.debug,
+                                   args.retries, args.backoff)
+        progress["done"] += 1
+        if not ok:
+            progress["failed"] += 1
+            return
+        if not args.debug:
+            manifest.record(file_name, content_hash)
+            size_mb = os.path.getsize(file_path) / (1024 * 1024)
+            print(f"[{progress['done']}/{len(uploads)}] Successfully uploaded {file_name} "
+                  f"({size_mb:.1f} MB in {time.perf_counter() - upload_start:.1f}s)")
+
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        await asyncio.gather(*[upload(session, *u) for u in uploads])
+
+    skipped = len(data_blocks) - len(uploads)
+    print(f"Uploaded {len(uploads) - progress['failed']} files, skipped {skipped} unchanged, "
+          f"{progress['failed']} failed in {time.perf_counter() - start:.1f}s")
+    return progress["failed"] == 0
+
 
 if __name__ == "__main__":
-    if len(sys.argv) < 3 or len(sys.argv) > 4:
-        print("Usage: python script.py <directory> <endpoint> [--debug]")
+    parser = argparse.ArgumentParser(description='Upload the baseball databank files to the upload_data endpoint.')
+    parser.add_argument('directory', type=str, help='Directory with the csv files')
+    parser.add_argument('endpoint', type=str, help='The upload_data endpoint')
+    parser.add_argument('--debug', action='store_true', help='Only print the equivalent curl commands')
+    parser.add_argument('--metadata', type=str, default=os.path.join(SCRIPT_DIRECTORY, 'baseball_databank.json'),
+                        help='File names and descriptions to upload')
+    parser.add_argument('--manifest', type=str, default=os.path.join(SCRIPT_DIRECTORY, '.upload_manifest.json'),
+                        help='Where to keep the hashes of the uploaded files')
+    parser.add_argument('--force', action='store_true', help='Upload every file, even if unchanged')
+    parser.add_argument('--concurrency', type=int, default=4, help='Number of files uploaded at the same time')
+    parser.add_argument('--retries', type=int, default=3, help='Retries per file')
+    parser.add_argument('--backoff', type=float, default=1.0, help='Base backoff in seconds, doubled per retry')
+    parser.add_argument('--timeout', type=float, default=600, help='Timeout per upload in seconds')
+
+    args = parser.parse_args()
+    if not asyncio.run(main(args)):
         sys.exit(1)
-    
-    directory = sys.argv[1]
-    endpoint = sys.argv[2]
-    debug = '--debug' in sys.argv
-    
-    asyncio.run(main(directory, endpoint, debug))
\ No newline at end of file
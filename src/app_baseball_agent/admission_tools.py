@@ -0,0 +1,92 @@
+import asyncio
+import logging
+import math
+import time
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"too many requests, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+# identical requests that arrive while one of them is being answered wait for
+# that answer instead of starting their own. The work runs in its own task so
+# a caller that goes away doesn't cancel it for the others
+class SingleFlight:
+    def __init__(self):
+        self.flights = {}
+        self.coalesced = 0
+
+    # returns (result, shared), shared is True for the callers that joined
+    async def do(self, key, fn):
+        task = self.flights.get(key)
+        if task is not None:
+            self.coalesced += 1
+            return await asyncio.shield(task), True
+        task = asyncio.create_task(fn())
+        self.flights[key] = task
+        task.add_done_callback(lambda _: self.flights.pop(key, None))
+        return await asyncio.shield(task), False
+
+    def snapshot(self):
+        return {"in_flight": len(self.flights), "coalesced": self.coalesced}
+
+
+# at most max_concurrency requests run, up to max_queue more wait for a slot
+# (no longer than queue_timeout seconds) and the rest are turned away right
+# away. Retry-After is estimated from how long requests took recently
+class AdmissionLimiter:
+    def __init__(self, max_concurrency=8, max_queue=32, queue_timeout=30):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.running = 0
+        self.waiting = 0
+        self.rejected = 0
+        self.average_duration = 1.0
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    def retry_after(self):
+        backlog = (self.waiting + self.running + 1) / self.max_concurrency
+        return max(1, math.ceil(backlog * self.average_duration))
+
+    def _reject(self, reason):
+        self.rejected += 1
+        retry_after = self.retry_after()
+        logging.warning(f"rejecting a request, {reason} (retry after {retry_after}s)")
+        raise AdmissionRejected(retry_after)
+
+    # raises right away when the queue is full, without taking a slot
+    def check(self):
+        if self._semaphore.locked() and self.waiting >= self.max_queue:
+            self._reject(f"{self.waiting} requests queued already")
+
+    # takes a slot, the caller has to release() it
+    async def acquire(self):
+        self.check()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._reject(f"no slot within {self.queue_timeout}s")
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        return time.monotonic()
+
+    def release(self, started):
+        self.running -= 1
+        self._semaphore.release()
+        # smoothed, one slow request shouldn't swing the estimate
+        self.average_duration = 0.8 * self.average_duration + 0.2 * (time.monotonic() - started)
+
+    def snapshot(self):
+        return {
+            "running": self.running,
+            "waiting": self.waiting,
+            "rejected": self.rejected,
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "average_duration_s": round(self.average_duration, 2),
+        }
@@ -1,4 +1,5 @@
 from fastapi import FastAPI, HTTPException, Depends
+from fastapi.responses import StreamingResponse, JSONResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
 import openai
@@ -11,19 +12,30 @@ from llama_index.agent.openai import OpenAIAgent
 from llama_index.embeddings.azure_openai import AzureOpenAIEmbedding
 from llama_index.core.evaluation import RelevancyEvaluator
 from llama_index.core.tools import ToolMetadata
-from llama_index.core.tools.eval_query_engine import EvalQueryEngineTool
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine
 import asyncio
 import asyncpg
 from llama_index.core import SQLDatabase
 from helper_tools import *
+from schema_tools import (introspect_schema, fetch_schema_fingerprint, schema_cache_key,
+                          load_schema_cache, save_schema_cache)
+from index_tools import build_table_index
+from cache_tools import SemanticCache
+from sql_tools import SQLPlanCache, CachedSQLRetriever, AsyncSQLExecutor
+from stream_tools import ToolCallEventHandler, stream_agent_events, sse_event
+from llama_index.core.instrumentation import get_dispatcher
+from monitor_tools import LoopLagMonitor, HealthProber
+from model_tools import ModelRegistry, ModelRouter, ModelPuller
+from admission_tools import AdmissionLimiter, AdmissionRejected, SingleFlight
+from cache_tools import normalize_question
+from trace_tools import (TraceEventHandler, TracedEvalQueryEngineTool, setup_tracing, shutdown_tracing,
+                         trace_request, trace_stage)
+from concurrent.futures import ThreadPoolExecutor
 from llama_index.core.agent import ReActAgent
 import random
 
 from llama_index.core.indices.struct_store.sql_query import SQLTableRetrieverQueryEngine
-from llama_index.core.objects import SQLTableNodeMapping, ObjectIndex, SQLTableSchema
 from llama_index.core.query_engine import NLSQLTableQueryEngine
-from llama_index.core import VectorStoreIndex
 from ollama import AsyncClient as oclient
 from llama_index.llms.ollama import Ollama
 from llama_index.embeddings.ollama import OllamaEmbedding
@@ -61,12 +73,113 @@ DEFAULT_EMBEDD_MODEL = "nomic-embed-text:latest"
 LLM_MODEL_PRIMARY = os.getenv("LLM_MODEL_PRIMARY", "azure_openai")
 logging.info(f"LLM_MODEL_PRIMARY: {LLM_MODEL_PRIMARY}")
 
+# the models we look for at the Ollama endpoint, in order of preference
+LLM_MODELS = [
+    LLM_MODEL_PRIMARY,
+    "llama3.1:405b",
+    "mixtral:latest",
+    "mixtral:8x22b",
+    "dolphin-mixtral:latest",
+    "sqlcoder:7b",
+    "qwen2.5-coder:32b",
+    "starcoder2:15b",
+    #"deepseek-coder-v2:236b",
+    #"duckdb-nsql",
+    "sqlcoder:15b"
+]
+
+# requests can pick their model, query engines and tools are kept for this many models at a time
+MODEL_CACHE_SIZE = int(os.getenv("MODEL_CACHE_SIZE", 3))
+
+# requests that don't ask for a model are routed by how complex the question looks,
+# the lists are in order of preference and models that aren't available are ignored
+ROUTER_ENABLED = os.getenv("ROUTER_ENABLED", "true").lower() == "true"
+ROUTER_SIMPLE_MODELS = [m.strip() for m in os.getenv("ROUTER_SIMPLE_MODELS", "sqlcoder:7b").split(",") if m.strip()]
+ROUTER_COMPLEX_MODELS = [m.strip() for m in os.getenv(
+    "ROUTER_COMPLEX_MODELS", "azure_openai,qwen2.5-coder:32b,mixtral:8x22b,llama3.1:405b").split(",") if m.strip()]
+ROUTER_COMPLEXITY_THRESHOLD = int(os.getenv("ROUTER_COMPLEXITY_THRESHOLD", 3))
+# a model is passed over while it has this many requests running, its p95 (seconds)
+# is over the limit or too many of its requests failed within the window (seconds)
+ROUTER_MAX_IN_FLIGHT = int(os.getenv("ROUTER_MAX_IN_FLIGHT", 4))
+ROUTER_MAX_P95 = float(os.getenv("ROUTER_MAX_P95", 60))
+ROUTER_MAX_ERROR_RATE = float(os.getenv("ROUTER_MAX_ERROR_RATE", 0.5))
+ROUTER_WINDOW = int(os.getenv("ROUTER_WINDOW", 300))
+# how many models /inference tries before giving up on a request
+ROUTER_MAX_ATTEMPTS = int(os.getenv("ROUTER_MAX_ATTEMPTS", 2))
+
+# missing Ollama models are pulled in the background, this many at once,
+# Azure OpenAI answers in the meantime. Models listed here are pulled as well
+OLLAMA_PULL_CONCURRENCY = int(os.getenv("OLLAMA_PULL_CONCURRENCY", 2))
+OLLAMA_PULL_MODELS = [m.strip() for m in os.getenv("OLLAMA_PULL_MODELS", "").split(",") if m.strip()]
+OLLAMA_LIST_TIMEOUT = float(os.getenv("OLLAMA_LIST_TIMEOUT", 10))
+
+# identical /inference requests in flight at the same time share one answer
+INFERENCE_COALESCE = os.getenv("INFERENCE_COALESCE", "true").lower() == "true"
+# agent runs per worker, requests beyond that wait in a queue of INFERENCE_MAX_QUEUE
+# (at most INFERENCE_QUEUE_TIMEOUT seconds), beyond that they get a 429
+INFERENCE_MAX_CONCURRENCY = int(os.getenv("INFERENCE_MAX_CONCURRENCY", 8))
+INFERENCE_MAX_QUEUE = int(os.getenv("INFERENCE_MAX_QUEUE", 32))
+INFERENCE_QUEUE_TIMEOUT = float(os.getenv("INFERENCE_QUEUE_TIMEOUT", 30))
+
 # these are optional as settings, we'll use the defined defaults otherwise
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
 OPENAI_API_VERSION = os.getenv("OPENAI_API_VERSION", "2024-08-01-preview")
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-ada-002")
 EMBEDDING_API_VERSION = os.getenv("EMBEDDING_API_VERSION", "2023-05-15")
 
+# rows per table we show the query engine and how many sample queries run at once
+SCHEMA_SAMPLE_ROWS = int(os.getenv("SCHEMA_SAMPLE_ROWS", 5))
+SCHEMA_INTROSPECTION_CONCURRENCY = int(os.getenv("SCHEMA_INTROSPECTION_CONCURRENCY", 5))
+
+# local state that survives restarts (schema cache, ...), set SCHEMA_CACHE_PATH to "" to disable the schema cache
+CACHE_DIRECTORY = os.getenv("CACHE_DIRECTORY", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache"))
+SCHEMA_CACHE_PATH = os.getenv("SCHEMA_CACHE_PATH", os.path.join(CACHE_DIRECTORY, "schema.json"))
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", os.path.join(CACHE_DIRECTORY, "table_embeddings.json"))
+
+# "all_tables" puts every table schema in the text-to-sql prompt, "retriever"
+# only the TABLE_RETRIEVER_TOP_K tables closest to the question
+QUERY_ENGINE_MODE = os.getenv("QUERY_ENGINE_MODE", "all_tables")
+TABLE_RETRIEVER_TOP_K = int(os.getenv("TABLE_RETRIEVER_TOP_K", 4))
+
+# blocking work (sync sql, file io) runs on a bounded pool instead of the event loop
+AGENT_THREAD_POOL_SIZE = int(os.getenv("AGENT_THREAD_POOL_SIZE", 16))
+# log whenever something holds the event loop longer than this
+LOOP_LAG_THRESHOLD_MS = int(os.getenv("LOOP_LAG_THRESHOLD_MS", 250))
+LOOP_LAG_INTERVAL_MS = int(os.getenv("LOOP_LAG_INTERVAL_MS", 500))
+# asyncio debug mode also names the slow callback, at some cost
+LOOP_DEBUG = os.getenv("LOOP_DEBUG", "false").lower() == "true"
+
+# spans are exported over OTLP/HTTP when an endpoint is set (e.g. http://localhost:4318),
+# this needs the optional opentelemetry-sdk and opentelemetry-exporter-otlp-proto-http packages
+OTEL_EXPORTER_OTLP_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT")
+OTEL_SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "baseball-agent")
+
+# /readyz and /health only report what the background prober found last
+HEALTH_PROBE_INTERVAL = int(os.getenv("HEALTH_PROBE_INTERVAL", 15))
+HEALTH_PROBE_TIMEOUT = int(os.getenv("HEALTH_PROBE_TIMEOUT", 5))
+
+# the generated SQL runs on its own async pool: bounded connections, a per statement
+# timeout, at most SQL_MAX_ROWS rows per result and SQL_MAX_CONCURRENT_QUERIES at once
+SQL_POOL_SIZE = int(os.getenv("SQL_POOL_SIZE", 5))
+SQL_POOL_MAX_OVERFLOW = int(os.getenv("SQL_POOL_MAX_OVERFLOW", 5))
+SQL_POOL_TIMEOUT = int(os.getenv("SQL_POOL_TIMEOUT", 10))
+SQL_STATEMENT_TIMEOUT_MS = int(os.getenv("SQL_STATEMENT_TIMEOUT_MS", 30000))
+SQL_MAX_ROWS = int(os.getenv("SQL_MAX_ROWS", 1000))
+SQL_MAX_CONCURRENT_QUERIES = int(os.getenv("SQL_MAX_CONCURRENT_QUERIES", 8))
+
+# answers to the same (or nearly the same) question are served from memory
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 512))
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", 3600))
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY", 0.95))
+RESPONSE_CACHE_FINGERPRINT_INTERVAL = int(os.getenv("RESPONSE_CACHE_FINGERPRINT_INTERVAL", 30))
+
+# generated SQL is reused for the same question as long as the schema and model stay the same,
+# set SQL_PLAN_CACHE_PATH to "" to keep the plans in memory only
+SQL_PLAN_CACHE_ENABLED = os.getenv("SQL_PLAN_CACHE_ENABLED", "true").lower() == "true"
+SQL_PLAN_CACHE_SIZE = int(os.getenv("SQL_PLAN_CACHE_SIZE", 1024))
+SQL_PLAN_CACHE_PATH = os.getenv("SQL_PLAN_CACHE_PATH", os.path.join(CACHE_DIRECTORY, "sql_plans.json"))
+
 # enable keys when we're ready
 security = HTTPBearer()
 TOKEN = "841e085171c01d5591602e6aff1701d8"
@@ -85,28 +198,121 @@ def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
 
 # start the app
 app = FastAPI()
+app.state.response_cache = SemanticCache(
+    max_entries=RESPONSE_CACHE_SIZE,
+    ttl=RESPONSE_CACHE_TTL,
+    similarity_threshold=RESPONSE_CACHE_SIMILARITY,
+    fingerprint_interval=RESPONSE_CACHE_FINGERPRINT_INTERVAL
+)
+app.state.probe_pool_lock = asyncio.Lock()
+app.state.sql_plan_cache = SQLPlanCache(max_entries=SQL_PLAN_CACHE_SIZE, path=SQL_PLAN_CACHE_PATH)
+
+# tool calls of every agent show up in the streaming endpoints
+get_dispatcher().add_event_handler(ToolCallEventHandler())
+get_dispatcher().add_event_handler(TraceEventHandler())
+
+app.state.loop_monitor = LoopLagMonitor(interval=LOOP_LAG_INTERVAL_MS / 1000, threshold=LOOP_LAG_THRESHOLD_MS / 1000)
+
+
+# every request is tracked so a blocked loop can be traced to the handlers that were running
+@app.middleware("http")
+async def track_in_flight(request, call_next):
+    request_id = app.state.loop_monitor.request_started(f"{request.method} {request.url.path}")
+    try:
+        return await call_next(request)
+    finally:
+        app.state.loop_monitor.request_finished(request_id)
 
 
 # start the server first before we do anything else
 @app.on_event("startup")
 async def init():
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=AGENT_THREAD_POOL_SIZE))
+    if LOOP_DEBUG:
+        loop.set_debug(True)
+        loop.slow_callback_duration = LOOP_LAG_THRESHOLD_MS / 1000
+    app.state.loop_monitor.start()
+    app.state.health_prober.start()
+    if OTEL_EXPORTER_OTLP_ENDPOINT:
+        setup_tracing(OTEL_SERVICE_NAME)
+    # don't hold up the server, /readyz reports when we're done
     logging.info("Scheduling initializing...")
+    app.state.init_task = asyncio.create_task(_init_logged())
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    app.state.model_puller.cancel()
+    shutdown_tracing()
+    app.state.health_prober.stop()
+    app.state.loop_monitor.stop()
+    if getattr(app.state, "probe_pool", None):
+        await app.state.probe_pool.close()
+    if getattr(app.state, "sql_executor", None):
+        await app.state.sql_executor.dispose()
+    await asyncio.to_thread(app.state.sql_plan_cache.flush)
+
+
+async def _init_logged():
     try:
-        await asyncio.create_task(_init())
+        await _init()
     except Exception as e:
         logging.error(f"Initialization failed: {e}")
 
+
 async def _init():
-    wait_time = random.randint(5, 20)
-    logging.info(f"Waiting for {wait_time} seconds before starting initialization...")
-    await asyncio.sleep(wait_time)
+    # a warm start uses the cached schema right away and checks it against the database afterwards
+    cached = _load_cached_schema()
+    if cached:
+        logging.info(f"Using the cached schema with {len(cached.tables)} tables, skipping the startup wait")
+        _apply_schema(cached)
+    else:
+        wait_time = random.randint(5, 20)
+        logging.info(f"Waiting for {wait_time} seconds before starting initialization...")
+        await asyncio.sleep(wait_time)
     logging.critical("================= Starting initialization...")
-    await _assemble_query_engine_seed()
+    if not cached:
+        await _assemble_query_engine_seed()
     await _prep_models() # & _setup_models(?)
     await _setup_query_engine()
     await _setup_tools_and_agent()
     await _setup_code_interpreter_agent()
     logging.critical("================= Initialization complete!")
+    if cached:
+        app.state.schema_revalidation = asyncio.create_task(_revalidate_schema())
+
+
+def _schema_cache_key():
+    return schema_cache_key(DATABASE_ENDPOINT, sample_rows=SCHEMA_SAMPLE_ROWS)
+
+
+def _load_cached_schema():
+    if not SCHEMA_CACHE_PATH:
+        return None
+    return load_schema_cache(SCHEMA_CACHE_PATH, _schema_cache_key())
+
+
+def _apply_schema(database_schema):
+    app.state.schema = database_schema
+    app.state.database_schema, app.state.sample_data = database_schema.as_query_engine_seed()
+
+
+# runs after a warm start: only re-introspect and rebuild the engine
+# if the database changed since the cache was written
+async def _revalidate_schema():
+    try:
+        fingerprint = await fetch_schema_fingerprint(await _probe_pool())
+        if fingerprint == app.state.schema.fingerprint:
+            logging.info("Cached schema is current")
+            return
+        logging.info("Database changed since the schema was cached, rebuilding the query engine")
+        if await _assemble_query_engine_seed():
+            await _setup_query_engine()
+            await _setup_tools_and_agent()
+            app.state.response_cache.invalidate("after the schema changed")
+    except Exception as e:
+        logging.error(f"Failed to revalidate the cached schema: {e}")
 
 
 
@@ -115,41 +321,20 @@ async def _init():
 async def _assemble_query_engine_seed():
 
     try:
-        # Connect to the database
-        conn = await asyncpg.connect(DATABASE_ENDPOINT)
-
-        # Get the table names
-        table_names = await conn.fetch("SELECT table_name FROM information_schema.tables WHERE table_schema='public'")
-        logging.info(f"table_names: {table_names}")
-
-        # Get the column names for each table
-        database_schema = {}
-        sample_data = {}
-        for table in table_names:
-            table_name = table["table_name"]
-            logging.info(f"fetching schema for table_name: {table_name}")
-            database_schema[table_name] = {}
-            column_names = await conn.fetch(f"SELECT column_name FROM information_schema.columns WHERE table_name='{table_name}'")
-            database_schema[table_name]["schema"] = [column["column_name"] for column in column_names]
-            table_description = await conn.fetch(f"SELECT obj_description(relfilenode, 'pg_class') AS table_comment FROM pg_class WHERE relname = '{table_name}' AND relnamespace = (SELECT oid FROM pg_namespace WHERE nspname = 'public');")
-            if table_description:
-                database_schema[table_name]["description"] = f"\033[95m {table_description[0]['table_comment']} \033[0m"
-            else:
-                database_schema[table_name]["description"] = "No description available"
-            sample_data[table_name] = await conn.fetch(str(text(f'SELECT * FROM "{table_name}" LIMIT 5')))
-
-        # Close the database connection
-        await conn.close()
-        logging.info(f"database_schema: {database_schema}")
-        logging.info(f"sample_data: {sample_data}")
-
-        # Store the data in the application state
-        app.state.database_schema = database_schema
-        app.state.sample_data = sample_data
+        # one catalog query for all tables, the samples are fetched in parallel
+        database_schema = await introspect_schema(DATABASE_ENDPOINT,
+                                                  sample_rows=SCHEMA_SAMPLE_ROWS,
+                                                  concurrency=SCHEMA_INTROSPECTION_CONCURRENCY)
+        for table in database_schema.tables.values():
+            logging.info(f"table: {table.name} \033[95m {table.description} \033[0m columns: {table.column_names}")
+
+        # Store the data in the application state and for the next start
+        _apply_schema(database_schema)
+        save_schema_cache(SCHEMA_CACHE_PATH, _schema_cache_key(), database_schema)
         return True
     except Exception as e:
         logging.error(f"Failed to assemble query engine seed: {e}")
-        return false
+        return False
 
 
 
@@ -158,72 +343,91 @@ async def _assemble_query_engine_seed():
 # if we have ollama models available
 #@app.on_event("startup")
 async def _prep_models():
-    llm_models = [
-        LLM_MODEL_PRIMARY,
-        "llama3.1:405b",
-        "mixtral:latest",
-        "mixtral:8x22b",
-        "dolphin-mixtral:latest",
-        "sqlcoder:7b",
-        "qwen2.5-coder:32b",
-        "starcoder2:15b",
-        #"deepseek-coder-v2:236b",
-        #"duckdb-nsql",
-        "sqlcoder:15b"
-    ]
+    # LLM_MODEL_PRIMARY may be azure_openai, which isn't an Ollama model
+    llm_models = [m for m in LLM_MODELS if m != "azure_openai"]
     embedding_model = DEFAULT_EMBEDD_MODEL
 
     llm_model = None
     try:
-        o = oclient(OLLAMA_ENDPOINT)
-        ollama_models = (await o.list())['models']
+        ollama_models = (await asyncio.wait_for(app.state.ollama.list(), OLLAMA_LIST_TIMEOUT))['models']
         logging.info("found the following models at the Ollama endpoint: %s" % ollama_models)
         model_names = [m["name"] for m in ollama_models]
+        # every model at the endpoint can be asked for per request
+        app.state.models.known_models.update(name for name in model_names if name != embedding_model)
         for model in ollama_models:
             logging.info(f"\033[95m \n === model: {model['name']} ===\n  >  size: {model['size']} \n  >  parameter#: {model['details']['parameter_size']}  \033[0m")
 
-        if not embedding_model in model_names:
-            logging.info("Pulling embedding model...")
-            await o.pull(embedding_model)
-            logging.info("....done")
-
         for tm in llm_models:
             if tm in model_names:
                 llm_model = tm
                 break
+
+        # missing models are pulled in the background, see /pull_status
+        pulls = []
+        if not embedding_model in model_names:
+            logging.info("Pulling embedding model...")
+            pulls.append(app.state.model_puller.pull(embedding_model))
         # if we didn't find any of the models we want we pull the first one
         if not llm_model:
-            tm = llm_models[0]
-            logging.info(f"Pulling llm model {tm}")
+            logging.info(f"Pulling llm model {llm_models[0]}")
+            pulls.append(app.state.model_puller.pull(llm_models[0], warm=True))
+        for tm in OLLAMA_PULL_MODELS:
+            if tm not in model_names:
+                pulls.append(app.state.model_puller.pull(tm, warm=True))
+
+        if llm_model and embedding_model in model_names:
+            await _setup_models(llm_model, embedding_model)
+            return
+        if not OPENAI_ENDPOINT:
+            # nothing else to answer with, wait for the pulls
             logging.info("This may take several minutes...")
-            await o.pull(tm)
+            await asyncio.gather(*pulls)
             logging.info("....done")
-        _setup_models(llm_model, embedding_model)
+            await _setup_models(llm_model or llm_models[0], embedding_model)
+            return
+        logging.info("Using Azure OpenAI while the Ollama models are pulled")
     except Exception as e:
         # if something fails we just use openai
-        logging.error("Failure pulling or determining Ollama models: ", str(e))
-        # fallback to openai
-        _setup_models()
-    
-   
+        logging.error(f"Failure pulling or determining Ollama models: {e}")
+    # fallback to openai
+    await _setup_models()
+
+
+# a pulled llm can be asked for right away, the embedding model only counts at the next start
+def _model_pulled(model_name):
+    if model_name != DEFAULT_EMBEDD_MODEL:
+        app.state.models.known_models.add(model_name)
+
+
+# a client for one llm, "azure_openai" or the name of an Ollama model
+def _build_llm(llm_model):
+    if llm_model == "azure_openai":
+        # Initialize the AzureOpenAI model
+        return AzureOpenAI(
+            deployment_name=OPENAI_MODEL,
+            model=OPENAI_MODEL,
+            api_key=OPENAI_API_KEY,
+            azure_endpoint=OPENAI_ENDPOINT,
+            api_version=OPENAI_API_VERSION,
+        )
+    return Ollama(
+        model=llm_model,
+        request_timeout=720.0,
+        base_url=OLLAMA_ENDPOINT,
+        temperature=0.1,
+        keep_alive="180m"
+    )
 
 
-# setup the embedding and llm models
+# setup the embedding and default llm models
 # use azure openai as stock in case we don't get anything different
-def _setup_models(llm_model="azure_openai", embedding_model="ada"):
+async def _setup_models(llm_model="azure_openai", embedding_model="ada"):
 
     try:
         logging.critical(f"\033[95m setting up llm model {llm_model} and embedding model {embedding_model} \033[0m")
-        llm = embed_model = None
+        llm = app.state.models.llm(llm_model)
+        embed_model = None
         if llm_model == "azure_openai":
-            # Initialize the AzureOpenAI model
-            llm = AzureOpenAI(
-                deployment_name=OPENAI_MODEL,
-                model=OPENAI_MODEL,
-                api_key=OPENAI_API_KEY,
-                azure_endpoint=OPENAI_ENDPOINT,
-                api_version=OPENAI_API_VERSION,
-            )
             # Initialize the AzureOpenAIEmbedding model
             embed_model = AzureOpenAIEmbedding(
                 model=EMBEDDING_MODEL,
@@ -233,13 +437,6 @@ def _setup_models(llm_model="azure_openai", embedding_model="ada"):
                 api_version=EMBEDDING_API_VERSION,
             )
         else:
-            llm = Ollama(
-                model=llm_model,
-                request_timeout=720.0,
-                base_url=OLLAMA_ENDPOINT,
-                temperature=0.1,
-                keep_alive="180m"
-            )
             embed_model = OllamaEmbedding(
                 model_name=embedding_model,
                 request_timeout=120.0,
@@ -248,19 +445,29 @@ def _setup_models(llm_model="azure_openai", embedding_model="ada"):
                 keep_alive="180m"
             )
 
-        logging.critical(f"\033[95m {str(llm.complete('mic check 1 2 3, you there?'))} \033[0m")
+        logging.critical(f"\033[95m {str(await llm.acomplete('mic check 1 2 3, you there?'))} \033[0m")
         logging.info("model setup complete")
+        # only set once at startup, as the fallback for anything that isn't handed a model;
+        # the embedding model stays the same for the whole process so cached embeddings stay comparable
         Settings.llm = llm
         Settings.embed_model = embed_model
+        app.state.models.known_models.add(llm_model)
+        app.state.models.default_model = llm_model
         return True
     except Exception as e:
         logging.error(f"Failure setting up models: {str(e)}")
         return False
 
 
+# the llm of the default model
+def _default_llm():
+    models = app.state.models
+    return models.llm() if models.default_model else Settings.llm
+
+
 # check if we're using openai
 def using_openai():
-    return isinstance(Settings.llm, AzureOpenAI)
+    return isinstance(_default_llm(), AzureOpenAI)
 
 
 # check database connection
@@ -280,51 +487,94 @@ async def check_connection(engine):
 async def _setup_query_engine():
     try:
         schema = app.state.database_schema
-        sample_data = app.state.sample_data
-        engine = create_engine(DATABASE_ENDPOINT)
+        # only used for reflection and the table context now, the queries go through app.state.sql_executor
+        engine = create_engine(DATABASE_ENDPOINT, pool_size=2, max_overflow=2, pool_pre_ping=True)
+        if getattr(app.state, "sql_executor", None) is None:
+            app.state.sql_executor = AsyncSQLExecutor(
+                DATABASE_ENDPOINT,
+                pool_size=SQL_POOL_SIZE,
+                max_overflow=SQL_POOL_MAX_OVERFLOW,
+                pool_timeout=SQL_POOL_TIMEOUT,
+                statement_timeout_ms=SQL_STATEMENT_TIMEOUT_MS,
+                max_rows=SQL_MAX_ROWS,
+                max_concurrency=SQL_MAX_CONCURRENT_QUERIES
+            )
         db_status = await check_connection(engine)
         logging.info(f"\033[95m {db_status} \033[0m")
-        sql_database = SQLDatabase(engine, include_tables=schema.keys())
+        # SQLDatabase reflects every table through the sync engine
+        sql_database = await asyncio.to_thread(SQLDatabase, engine, include_tables=list(schema.keys()))
 
-        # build out indexer compatible objects
-        table_node_mapping = SQLTableNodeMapping(sql_database)
-        
-        table_schema_objs = []
         tables = schema.keys()
         for table in tables:
             logging.info(f"table: {table} with description: {schema[table]['description']}")
-            table_schema_objs.append((SQLTableSchema(table_name=table, context_str=schema[table]['description'])))
-
-        # just use an in-memory index for now
-        obj_index = ObjectIndex.from_objects(
-            table_schema_objs,
-            table_node_mapping,
-            VectorStoreIndex,
-        )
 
-        query_engine = None
-        #if using_openai():
-            # Create the NLSQLTableQueryEngine
-        query_engine = NLSQLTableQueryEngine(
-            sql_database=sql_database,
-            tables=tables,
-            database_schema=schema,
-            sample_data=sample_data,
-
-        )
+        table_retriever = None
+        if QUERY_ENGINE_MODE == "retriever":
+            # only the tables relevant to the question end up in the prompt,
+            # the table embeddings are cached so only changed tables get embedded again
+            obj_index = await build_table_index(app.state.schema, sql_database, Settings.embed_model,
+                                                EMBEDDING_CACHE_PATH)
+            table_retriever = obj_index.as_retriever(similarity_top_k=TABLE_RETRIEVER_TOP_K)
+
+        # shared by the query engines of all models
+        app.state.sql_database = sql_database
+        app.state.table_retriever = table_retriever
+        app.state.query_engine = _build_query_engine(_default_llm())
         logging.critical(f"\033[95m Query engine ready! \033[0m")
-        app.state.query_engine = query_engine
         return True
     except Exception as e:
         logging.error(f"Failed to set up query engine: {e}")
         return False
 
 
+# a query engine for one model on top of the shared database, table index and sql pool
+def _build_query_engine(llm):
+    schema = app.state.database_schema
+    query_engine = None
+    if app.state.table_retriever is not None:
+        query_engine = SQLTableRetrieverQueryEngine(
+            app.state.sql_database,
+            app.state.table_retriever,
+            llm=llm,
+        )
+    else:
+        # Create the NLSQLTableQueryEngine
+        query_engine = NLSQLTableQueryEngine(
+            sql_database=app.state.sql_database,
+            tables=schema.keys(),
+            database_schema=schema,
+            sample_data=app.state.sample_data,
+            llm=llm,
+        )
+    # both engines generate their SQL through this retriever, it also
+    # reports the SQL and rows to the streaming endpoints
+    plan_cache = app.state.sql_plan_cache if SQL_PLAN_CACHE_ENABLED else SQLPlanCache(max_entries=0)
+    query_engine._sql_retriever = CachedSQLRetriever(query_engine.sql_retriever,
+                                                     plan_cache,
+                                                     app.state.schema.schema_version,
+                                                     app.state.sql_executor)
+    return query_engine
+
+
 #@app.on_event("startup")
 async def _setup_tools_and_agent():
 
     try:
-        evaluator = RelevancyEvaluator()
+        # the tools of all models used the old query engine
+        models = app.state.models
+        models.invalidate_tools()
+        tools = _build_tools(_default_llm(), app.state.query_engine)
+        models.add_tools(models.default_model, tools)
+        app.state.agent = _build_agent(_default_llm(), tools)
+        return True
+    except Exception as e:
+        logging.error(f"Failed to set up tools and agent: {e}")
+        return False
+
+
+# the baseball stats tools of one model
+def _build_tools(llm, query_engine):
+        evaluator = RelevancyEvaluator(llm=llm)
         """
         image_fetcher_metadata = ToolMetadata(
             name="image-fetcher",
@@ -338,9 +588,9 @@ async def _setup_tools_and_agent():
         #    pool_management_ID is the playerid from the database. Download all the images which have /images/headshots/ as part of their directory location and save them in /data. The tool returns the result, stdout and stderr."
 
         tools = [
-            EvalQueryEngineTool(
+            TracedEvalQueryEngineTool(
                 evaluator=evaluator,
-                query_engine=app.state.query_engine,
+                query_engine=query_engine,
                 metadata=ToolMetadata(
                     name="historical-baseball-stats",
                     # prompt is defined in helper_functions
@@ -351,21 +601,49 @@ async def _setup_tools_and_agent():
             ),
         ]
         #tools.append(image_fetcher)
-        agent = None
-        if using_openai():
-            agent = OpenAIAgent.from_tools(tools, verbose=True)
-        else:
-            agent = ReActAgent.from_tools(tools=tools, verbose=True)
-        app.state.agent = agent
-        return True
-    except Exception as e:
-        logging.error(f"Failed to set up tools and agent: {e}")
-        return False
+        return tools
+
+
+async def _build_model_tools(model_name, llm):
+    return _build_tools(llm, _build_query_engine(llm))
+
+
+# every request gets its own agent, the memory of an agent isn't safe to share between chats
+def _build_agent(llm, tools):
+    if isinstance(llm, AzureOpenAI):
+        return OpenAIAgent.from_tools(tools, llm=llm, verbose=True)
+    return ReActAgent.from_tools(tools=tools, llm=llm, verbose=True)
+
+
+app.state.models = ModelRegistry(_build_llm, _build_model_tools, _build_agent, max_models=MODEL_CACHE_SIZE)
+# Azure OpenAI can be asked for whenever it is configured, not only as the default model
+if OPENAI_ENDPOINT:
+    app.state.models.known_models.add("azure_openai")
+# one client for every call to the Ollama endpoint
+app.state.ollama = oclient(OLLAMA_ENDPOINT)
+app.state.model_puller = ModelPuller(app.state.ollama, concurrency=OLLAMA_PULL_CONCURRENCY,
+                                     on_ready=_model_pulled)
+app.state.router = ModelRouter(
+    app.state.models,
+    ROUTER_SIMPLE_MODELS,
+    ROUTER_COMPLEX_MODELS,
+    complexity_threshold=ROUTER_COMPLEXITY_THRESHOLD,
+    max_in_flight=ROUTER_MAX_IN_FLIGHT,
+    max_p95=ROUTER_MAX_P95,
+    max_error_rate=ROUTER_MAX_ERROR_RATE,
+    window=ROUTER_WINDOW,
+)
+app.state.inference_flights = SingleFlight()
+app.state.inference_limiter = AdmissionLimiter(
+    max_concurrency=INFERENCE_MAX_CONCURRENCY,
+    max_queue=INFERENCE_MAX_QUEUE,
+    queue_timeout=INFERENCE_QUEUE_TIMEOUT,
+)
 
 
 #@app.on_event("startup")
 async def _setup_code_interpreter_agent():
-    code_interpreter_tool = CustomAzureCodeInterpreterToolSpec(
+    app.state.code_interpreter_tool = CustomAzureCodeInterpreterToolSpec(
         pool_management_endpoint=SESSIONS_ENDPOINT,
         metadata=ToolMetadata(
             name="secure-sessions-code-interpreter",
@@ -373,8 +651,12 @@ async def _setup_code_interpreter_agent():
         )
     )
 
-    app.state.code_interpreter_agent = ReActAgent.from_tools(
-        tools=[code_interpreter_tool],
+
+# a new agent per request so concurrent chats don't share a memory
+def _code_interpreter_agent():
+    return ReActAgent.from_tools(
+        tools=[app.state.code_interpreter_tool],
+        llm=_default_llm(),
         verbose=True
     )
 
@@ -382,9 +664,10 @@ async def _setup_code_interpreter_agent():
 # used for straight up code inference and execution
 @app.post("/python_code_inference", response_model=CodeInferenceResponse, tags=["Inference"])
 async def session_python_interpreter(request: CodeInferenceRequest):
-    agent = app.state.code_interpreter_agent
     try:
-        response = await agent.achat(request.code)
+        agent = _code_interpreter_agent()
+        with trace_request("python_code_inference"):
+            response = await agent.achat(request.code)
         result = {
             "answer": response.output,
             "reasoning": response.reasoning  # Access the agent's thoughts here
@@ -395,50 +678,229 @@ async def session_python_interpreter(request: CodeInferenceRequest):
 
 
 
+# keep proxies from buffering the stream
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+# same as /python_code_inference but streams server-sent events: tool calls,
+# then the tokens of the answer and a final "done" event
+@app.post("/python_code_inference/stream", tags=["Inference"])
+async def session_python_interpreter_stream(request: CodeInferenceRequest):
+    agent = _code_interpreter_agent()
+
+    async def events():
+        async for event, data in stream_agent_events(agent, request.code):
+            yield sse_event(event, data)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+# the models to try for a request, best first: the one it asked for,
+# otherwise the router's picks, otherwise the default model
+def _request_models(request: InferenceRequest):
+    if request.omodel_name:
+        if not app.state.models.is_known(request.omodel_name):
+            raise HTTPException(status_code=400, detail=f"Unknown model {request.omodel_name}, see /list_models")
+        return [request.omodel_name], {"tier": "requested"}
+    if ROUTER_ENABLED:
+        model_names, route = app.state.router.route(request.query)
+        if model_names:
+            return model_names, route
+    return [app.state.models.default_model], {"tier": "default"}
+
+
+# asks the models in turn until one answers, every attempt counts towards the router's stats
+async def _chat_with_fallback(model_names, query):
+    model_names = model_names[:max(1, ROUTER_MAX_ATTEMPTS)]
+    for attempt, model_name in enumerate(model_names):
+        try:
+            agent = await app.state.models.agent(model_name)
+            with app.state.router.track(model_name), trace_stage("agent", model=model_name):
+                response = await agent.achat(query)
+            return model_name, response
+        except Exception as e:
+            if attempt == len(model_names) - 1:
+                raise
+            logging.warning(f"{model_name} failed, falling back to {model_names[attempt + 1]}: {e}")
+
+
+def _too_many_requests(e: AdmissionRejected):
+    return HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+
 # use for baseball stats inference
 @app.post("/inference", response_model=InferenceResponse, tags=["Inference"])
 async def model_inference(request: InferenceRequest):
-    agent = app.state.agent
+    model_names, route = _request_models(request)
     try:
+        if not INFERENCE_COALESCE:
+            response, res = await _answer(request, model_names, route)
+            return InferenceResponse(response=response, metadata=res)
+        # a dashboard refresh sends the same question many times at once, answer it once
+        key = (request.omodel_name, request.use_cache, normalize_question(request.query))
+        (response, res), shared = await app.state.inference_flights.do(
+            key, lambda: _answer(request, model_names, route))
+        return InferenceResponse(response=response, metadata={**res, "coalesced": shared})
+    except AdmissionRejected as e:
+        raise _too_many_requests(e)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# the answer and metadata of one /inference request, from the cache when possible.
+# The metadata breaks the time down by stage, see trace_tools
+async def _answer(request: InferenceRequest, model_names, route):
+    with trace_request("inference", question=request.query, requested_model=request.omodel_name) as breakdown:
         start = time.time()
-        response = await agent.achat(request.query)
+        cache = app.state.response_cache if RESPONSE_CACHE_ENABLED and request.use_cache else None
+        cache_info = {"status": "disabled"}
+        embedding = None
+        if cache:
+            # cached answers belong to the model that gave them
+            scope = model_names[0]
+            with trace_stage("response_cache") as stage:
+                entry, cache_info, embedding = await cache.get(scope, request.query, Settings.embed_model)
+                stage.set("cache.status", cache_info["status"])
+            if entry:
+                res = dict(entry.metadata)
+                res["inference_time"] = f"{time.time() - start:.2f}"
+                res["cache"] = cache_info
+                res["stages"] = breakdown.snapshot()
+                return entry.response, res
+
+        # cache hits don't need a slot
+        limiter = app.state.inference_limiter
+        with trace_stage("queue"):
+            slot = await limiter.acquire()
+        queue_time = time.time() - start
+        try:
+            model_name, response = await _chat_with_fallback(model_names, request.query)
+        finally:
+            limiter.release(slot)
         end = time.time()
         inference_time = end - start
         res = {
-            "omodel_name": Settings.llm.name,
-            "inference_time": f"{inference_time:.2f}"
+            "omodel_name": model_name,
+            "inference_time": f"{inference_time:.2f}",
+            "queue_time": f"{queue_time:.2f}",
+            "route": route
         }
-        return InferenceResponse(response=response.response, metadata=res)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        if cache:
+            cache.put(model_name, request.query, response.response, res, embedding)
+        res["cache"] = cache_info
+        res["stages"] = breakdown.snapshot()
+        return response.response, res
+
+
+
+# same as /inference but streams server-sent events: tool calls, the
+# generated SQL and its row count, then the tokens of the answer and a
+# final "done" event with the whole response and its metadata
+@app.post("/inference/stream", tags=["Inference"])
+async def model_inference_stream(request: InferenceRequest):
+    model_names, route = _request_models(request)
+    # the stream waits for its slot itself, turn it away now if it couldn't even queue
+    try:
+        app.state.inference_limiter.check()
+    except AdmissionRejected as e:
+        raise _too_many_requests(e)
+    return StreamingResponse(_inference_events(model_names[0], route, request), media_type="text/event-stream",
+                             headers=SSE_HEADERS)
+
+
+# no fallback here, once tokens went out the answer can't switch models
+async def _inference_events(model_name, route, request):
+    start = time.time()
+    cache = app.state.response_cache if RESPONSE_CACHE_ENABLED and request.use_cache else None
+    cache_info = {"status": "disabled"}
+    embedding = None
+    yield sse_event("start", {"omodel_name": model_name, "route": route})
+    if cache:
+        scope = model_name
+        entry, cache_info, embedding = await cache.get(scope, request.query, Settings.embed_model)
+        if entry:
+            res = dict(entry.metadata)
+            res["inference_time"] = f"{time.time() - start:.2f}"
+            res["cache"] = cache_info
+            yield sse_event("token", {"text": entry.response})
+            yield sse_event("done", {"response": entry.response, "metadata": res})
+            return
+
+    limiter = app.state.inference_limiter
+    try:
+        slot = await limiter.acquire()
+    except AdmissionRejected as e:
+        yield sse_event("error", {"detail": str(e), "retry_after": e.retry_after})
+        return
+    try:
+        try:
+            agent = await app.state.models.agent(model_name)
+        except Exception as e:
+            logging.error(f"Failed to build the agent for {model_name}: {e}")
+            yield sse_event("error", {"detail": str(e)})
+            return
+
+        router = app.state.router
+        agent_start = time.monotonic()
+        ok = False
+        router.started(model_name)
+        try:
+            async for event, data in stream_agent_events(agent, request.query):
+                if event != "done":
+                    yield sse_event(event, data)
+                    continue
+                ok = True
+                res = {
+                    "omodel_name": model_name,
+                    "inference_time": data["inference_time"],
+                    "first_token_time": data["first_token_time"],
+                    "route": route
+                }
+                if cache:
+                    cache.put(scope, request.query, data["response"], res, embedding)
+                res["cache"] = cache_info
+                yield sse_event("done", {"response": data["response"], "metadata": res})
+        finally:
+            router.finished(model_name, time.monotonic() - agent_start, ok)
+    finally:
+        limiter.release(slot)
 
 
 
 @app.get("/list_models", tags=["Agent Control"])
 async def list_models():
     try:
-        o = oclient(OLLAMA_ENDPOINT)
-        ollama_models = await o.list()['models']
+        ollama_models = (await app.state.ollama.list())['models']
         model_names = [m["name"] for m in ollama_models]
-        return {"models": model_names}
+        return {"models": model_names, "pulling": app.state.model_puller.in_progress()}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.post("/set_model", tags=["Agent Control"])
-async def set_model(request: ModelRequest):
-    try:
-        _setup_models(llm_model=request.omodel_name, embedding_model="bge-large")
-        return {"status": "model set successfully"}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+# pulls a model at the Ollama endpoint in the background, follow it on /pull_status
+@app.post("/pull_model", status_code=202, tags=["Agent Control"])
+async def pull_model(request: ModelRequest):
+    app.state.model_puller.pull(request.omodel_name, warm=request.omodel_name != DEFAULT_EMBEDD_MODEL)
+    return {"status": "pull started", "job": app.state.model_puller.jobs[request.omodel_name]}
+
 
+@app.get("/pull_status", tags=["Agent Control"])
+async def pull_status():
+    return {"jobs": app.state.model_puller.snapshot(), "models": app.state.models.snapshot()}
 
+
+# switches the model of requests that don't ask for one. The agent of the new
+# model is built before the switch, requests in flight keep the agent they have
 @app.post("/set_model", tags=["Agent Control"])
 async def set_model(request: ModelRequest):
+    models = app.state.models
+    if not models.is_known(request.omodel_name):
+        raise HTTPException(status_code=400, detail=f"Unknown model {request.omodel_name}, see /list_models")
     try:
-        _setup_models(llm_model=request.omodel_name, embedding_model="bge-large")
-        return {"status": "model set successfully"}
+        await models.model_tools(request.omodel_name)
+        await models.llm(request.omodel_name).acomplete("mic check 1 2 3, you there?")
+        models.default_model = request.omodel_name
+        return {"status": "model set successfully", "models": models.snapshot()}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -452,39 +914,107 @@ async def rebuild_index():
             raise Exception("Failed to rebuild index")
         else:
             await _setup_query_engine()
+            await _setup_tools_and_agent()
+            app.state.response_cache.invalidate("after rebuilding the index")
         return {"status": "Reindexing started successfully"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 
+# a small pool for the readiness probe and the schema fingerprint, so neither
+# opens a connection of its own each time
+async def _probe_pool():
+    async with app.state.probe_pool_lock:
+        if getattr(app.state, "probe_pool", None) is None:
+            app.state.probe_pool = await asyncpg.create_pool(DATABASE_ENDPOINT, min_size=1, max_size=2)
+    return app.state.probe_pool
+
+
+# readiness checks, run by app.state.health_prober in the background
+async def _probe_database():
+    pool = await _probe_pool()
+    await pool.fetchval("SELECT 1")
+    # the response cache is dropped when the database changed, checked here
+    # rather than on the request path (at most every fingerprint_interval)
+    await app.state.response_cache.check_fingerprint(lambda: fetch_schema_fingerprint(pool))
+    return f"Connection successful to {DATABASE_ENDPOINT[40:60]}!"
+
+
+# lists the models instead of asking one, so a probe never costs a completion
+async def _probe_llm():
+    if using_openai():
+        if getattr(app.state, "probe_openai_client", None) is None:
+            app.state.probe_openai_client = openai.AsyncAzureOpenAI(
+                api_key=OPENAI_API_KEY,
+                azure_endpoint=OPENAI_ENDPOINT,
+                api_version=OPENAI_API_VERSION,
+            )
+        await app.state.probe_openai_client.models.list()
+        return f"Azure OpenAI reachable, using {OPENAI_MODEL}"
+    llm_model = _default_llm().model
+    model_names = [m["name"] for m in (await app.state.ollama.list())["models"]]
+    if llm_model not in model_names:
+        raise RuntimeError(f"{llm_model} is not available at the Ollama endpoint")
+    return f"Ollama reachable, using {llm_model}"
+
+
+async def _probe_initialized():
+    missing = [name for name in ("query_engine", "agent", "code_interpreter_tool") if not hasattr(app.state, name)]
+    if missing:
+        raise RuntimeError(f"not initialized yet: {', '.join(missing)}")
+    return "query engine and agents ready"
+
+
+app.state.health_prober = HealthProber({
+    "database": _probe_database,
+    "llm": _probe_llm,
+    "initialized": _probe_initialized,
+}, interval=HEALTH_PROBE_INTERVAL, timeout=HEALTH_PROBE_TIMEOUT)
+
+
+# the process is up and its event loop is turning
+@app.get("/livez", tags=["Health"])
+async def liveness_check():
+    return {"status": "alive", "event_loop": app.state.loop_monitor.snapshot()}
+
+
+# ready to take /inference requests, from the prober's last results
+@app.get("/readyz", tags=["Health"])
+async def readiness_check():
+    prober = app.state.health_prober
+    content = {"status": "ready" if prober.ready else "not ready", "checks": prober.results}
+    return JSONResponse(content=content, status_code=200 if prober.ready else 503)
+
+
 @app.get("/health", tags=["Health"])
 async def health_check():
-
-    db_status = await check_connection(DATABASE_ENDPOINT)
+    results = app.state.health_prober.results
     
     llm_model = embedding_model = "NA"
     # Get current LLM and embedding model
-    if not using_openai() and Settings.llm and Settings.embed_model:
-        llm_model = Settings.llm.model
-        embedding_model = Settings.embed_model.model_name
-    elif not using_openai():
-        llm_model = "Failed to retrieve"
-        embedding_model = "Failed to retrieve"
-    else:
-        llm_model = OPENAI_MODEL
-        embedding_model = EMBEDDING_MODEL
-
-    # Send a "mic check" to the LLM
     try:
-        mic_check = Settings.llm.complete("mic check 1 2 3, you there?")
+        if not using_openai() and _default_llm() and Settings.embed_model:
+            llm_model = _default_llm().model
+            embedding_model = Settings.embed_model.model_name
+        elif not using_openai():
+            llm_model = "Failed to retrieve"
+            embedding_model = "Failed to retrieve"
+        else:
+            llm_model = OPENAI_MODEL
+            embedding_model = EMBEDDING_MODEL
     except Exception as e:
-        mic_check = f"LLM mic check failed: {str(e)}"
+        llm_model = embedding_model = f"Failed to retrieve: {e}"
 
     return {
-        "status": "healthy",
-        "database_status": str(db_status),
+        "status": "healthy" if app.state.health_prober.ready else "degraded",
+        "event_loop": app.state.loop_monitor.snapshot(),
+        "database_status": results.get("database", {}).get("detail", "not checked yet"),
         "llm_model": str(llm_model),
         "embedding_model": str(embedding_model),
-        "llm_mic_check": str(mic_check)
-    }
\ No newline at end of file
+        "llm_status": results.get("llm", {}).get("detail", "not checked yet"),
+        "models": app.state.models.snapshot(),
+        "model_stats": app.state.router.snapshot(),
+        "admission": {**app.state.inference_limiter.snapshot(), **app.state.inference_flights.snapshot()},
+        "checks": results
+    }
@@ -0,0 +1,161 @@
+import asyncio
+import copy
+import logging
+import re
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import FrozenSet, List, Optional
+
+import numpy as np
+
+
+def normalize_question(question: str) -> str:
+    # "Who hit the most home runs in 1998?" and "who hit the most home runs in 1998" are the same question
+    return re.sub(r"\s+", " ", question).strip().rstrip("?!.").strip().lower()
+
+
+# numbers, quoted strings and capitalized words after the first one
+_LITERAL_PATTERN = re.compile(r"\"[^\"]+\"|'[^']+'|\d+(?:\.\d+)?|\b[A-Z][\w.'-]*")
+
+
+# the parts of a question embeddings barely tell apart: "most home runs in 1998"
+# and "most home runs in 1999" are close neighbours but have different answers
+def literal_tokens(question: str) -> FrozenSet[str]:
+    question = question.strip()
+    # the first word is capitalized anyway
+    return frozenset(match.group().strip("\"'").lower() for match in _LITERAL_PATTERN.finditer(question)
+                     if match.start() > 0 or not match.group()[:1].isupper())
+
+
+@dataclass
+class CacheEntry:
+    question: str
+    embedding: Optional[List[float]]
+    response: str
+    metadata: dict
+    literals: FrozenSet[str] = frozenset()
+    created: float = field(default_factory=time.time)
+
+
+# answers of the agent, found by the normalized question first and by
+# embedding similarity second. Entries expire after ttl seconds, the least
+# recently used ones are dropped beyond max_entries, and everything is
+# dropped when the data underneath changes (see check_fingerprint)
+class SemanticCache:
+    def __init__(self, max_entries=512, ttl=3600, similarity_threshold=0.95, fingerprint_interval=30):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.fingerprint_interval = fingerprint_interval
+        self.entries = OrderedDict()
+        self.fingerprint = None
+        self.fingerprint_checked = 0.0
+        self._fingerprint_lock = asyncio.Lock()
+        self.hits = {"exact": 0, "semantic": 0}
+        self.misses = 0
+
+    def invalidate(self, reason=""):
+        if self.entries:
+            logging.info(f"dropping {len(self.entries)} cached responses {reason}".strip())
+        self.entries.clear()
+
+    # ingests change the answers, so every now and then compare the database
+    # fingerprint and start over when it moved
+    async def check_fingerprint(self, fetch_fingerprint):
+        if time.time() - self.fingerprint_checked < self.fingerprint_interval:
+            return
+        async with self._fingerprint_lock:
+            if time.time() - self.fingerprint_checked < self.fingerprint_interval:
+                return
+            try:
+                fingerprint = await fetch_fingerprint()
+            except Exception as e:
+                logging.warning(f"Failed to check the database fingerprint: {e}")
+                return
+            finally:
+                self.fingerprint_checked = time.time()
+            if self.fingerprint is not None and fingerprint != self.fingerprint:
+                self.invalidate("because the database changed")
+            self.fingerprint = fingerprint
+
+    def _expired(self, entry: CacheEntry) -> bool:
+        return time.time() - entry.created > self.ttl
+
+    def _get_exact(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if self._expired(entry):
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    # only questions with the same years, numbers and names are compared
+    def _get_similar(self, scope, embedding, literals):
+        keys, vectors = [], []
+        for key, entry in list(self.entries.items()):
+            if key[0] != scope or entry.embedding is None or entry.literals != literals:
+                continue
+            if self._expired(entry):
+                del self.entries[key]
+                continue
+            keys.append(key)
+            vectors.append(entry.embedding)
+        if not keys:
+            return None, 0.0
+        matrix = np.asarray(vectors, dtype=np.float32)
+        query = np.asarray(embedding, dtype=np.float32)
+        similarities = matrix @ query / (np.linalg.norm(matrix, axis=1) * np.linalg.norm(query) + 1e-12)
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.similarity_threshold:
+            return None, float(similarities[best])
+        self.entries.move_to_end(keys[best])
+        return self.entries[keys[best]], float(similarities[best])
+
+    # returns (entry, info, embedding). The embedding of a miss is handed back
+    # so put() doesn't have to embed the question a second time. scope keeps
+    # the answers of different models apart
+    async def get(self, scope, question, embed_model=None):
+        key = (scope, normalize_question(question))
+        entry = self._get_exact(key)
+        if entry is not None:
+            self.hits["exact"] += 1
+            return entry, self._info("exact", 1.0), None
+
+        embedding = None
+        similarity = 0.0
+        if embed_model is not None and self.similarity_threshold < 1.0:
+            try:
+                embedding = await embed_model.aget_query_embedding(key[1])
+                entry, similarity = self._get_similar(scope, embedding, literal_tokens(question))
+            except Exception as e:
+                logging.warning(f"Failed to embed the question for the response cache: {e}")
+                entry = None
+            if entry is not None:
+                self.hits["semantic"] += 1
+                return entry, self._info("semantic", similarity), embedding
+        self.misses += 1
+        return None, self._info("miss", similarity), embedding
+
+    def put(self, scope, question, response, metadata, embedding=None):
+        key = (scope, normalize_question(question))
+        # the caller may keep changing its metadata after this
+        self.entries[key] = CacheEntry(question=question, embedding=embedding, response=response,
+                                       metadata=copy.deepcopy(metadata), literals=literal_tokens(question))
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _info(self, status, similarity):
+        hits = self.hits["exact"] + self.hits["semantic"]
+        lookups = hits + self.misses
+        return {
+            "status": status,
+            "similarity": round(similarity, 4),
+            "entries": len(self.entries),
+            "hits": hits,
+            "misses": self.misses,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+        }
@@ -1,11 +1,15 @@
 from llama_index.tools.azure_code_interpreter import AzureCodeInterpreterToolSpec
 from llama_index.core.tools import ToolMetadata
 from pydantic import BaseModel
+from typing import Optional
 
 
 # these get used in baseball_agent.py putting here for cleaner code
 class InferenceRequest(BaseModel):
     query: str
+    use_cache: bool = True
+    # the default model (see /set_model) when not given
+    omodel_name: Optional[str] = None
 
 class InferenceResponse(BaseModel):
     response: str
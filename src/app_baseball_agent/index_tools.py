@@ -0,0 +1,107 @@
+import hashlib
+import json
+import logging
+import os
+
+from llama_index.core import VectorStoreIndex
+from llama_index.core.objects import ObjectIndex, SQLTableNodeMapping
+from llama_index.core.schema import MetadataMode, TextNode
+
+from schema_tools import DatabaseSchema, TableSchema
+
+
+# bump whenever the table node text or the cache layout changes
+EMBEDDING_CACHE_VERSION = 1
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def embed_model_key(embed_model) -> str:
+    return f"{type(embed_model).__name__}:{getattr(embed_model, 'model_name', '')}"
+
+
+# embeddings of the table schemas keyed by the hash of the embedded text, one
+# section per embedding model, so a restart only embeds tables that changed
+class EmbeddingCache:
+    def __init__(self, path, model_key):
+        self.path = path
+        self.model_key = model_key
+        self.models = {}
+        if path and os.path.isfile(path):
+            try:
+                with open(path, "r") as f:
+                    data = json.load(f)
+                if data.get("version") == EMBEDDING_CACHE_VERSION:
+                    self.models = data.get("models", {})
+            except (OSError, ValueError) as e:
+                logging.warning(f"Failed to read embedding cache {path}: {e}")
+        self.embeddings = self.models.get(model_key, {})
+
+    def get(self, key):
+        return self.embeddings.get(key)
+
+    # keep only the embeddings of the current tables so the file doesn't grow forever
+    def save(self, embeddings):
+        self.embeddings = embeddings
+        self.models[self.model_key] = embeddings
+        if not self.path:
+            return
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"version": EMBEDDING_CACHE_VERSION, "models": self.models}, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.warning(f"Failed to write embedding cache {self.path}: {e}")
+
+
+# same text and metadata SQLTableNodeMapping.to_node produces, but built from the
+# introspected schema instead of one inspector round trip per table
+def table_node(table: TableSchema) -> TextNode:
+    columns = ", ".join(
+        f"{column.name} ({column.data_type}): '{column.description}'" if column.description
+        else f"{column.name} ({column.data_type})"
+        for column in table.columns
+    )
+    table_text = (
+        f"Schema of table {table.name}:\n"
+        f"Table '{table.name}' has columns: {columns}.\n"
+        f"Context of table {table.name}:\n"
+        f"{table.description}"
+    )
+    return TextNode(
+        id_=content_hash(table_text),
+        text=table_text,
+        metadata={"name": table.name, "context": table.description},
+        excluded_embed_metadata_keys=["name", "context"],
+        excluded_llm_metadata_keys=["name", "context"],
+    )
+
+
+# build the table ObjectIndex, embedding only the tables whose schema text isn't in the cache
+async def build_table_index(database_schema: DatabaseSchema, sql_database, embed_model, cache_path):
+    cache = EmbeddingCache(cache_path, embed_model_key(embed_model))
+    nodes = [table_node(table) for table in database_schema.tables.values()]
+    keys = [content_hash(node.get_content(metadata_mode=MetadataMode.EMBED)) for node in nodes]
+
+    missing = [(node, key) for node, key in zip(nodes, keys) if cache.get(key) is None]
+    if missing:
+        texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node, _ in missing]
+        new_embeddings = await embed_model.aget_text_embedding_batch(texts)
+        new_embeddings = {key: embedding for (_, key), embedding in zip(missing, new_embeddings)}
+    else:
+        new_embeddings = {}
+
+    embeddings = {}
+    for node, key in zip(nodes, keys):
+        node.embedding = new_embeddings.get(key) or cache.get(key)
+        embeddings[key] = node.embedding
+    cache.save(embeddings)
+    logging.info(f"table index: embedded {len(missing)} tables, {len(nodes) - len(missing)} from the cache")
+
+    # every node already has its embedding, so the index doesn't call the model again
+    index = VectorStoreIndex(nodes=nodes, embed_model=embed_model)
+    return ObjectIndex(index, SQLTableNodeMapping(sql_database))
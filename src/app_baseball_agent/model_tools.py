@@ -0,0 +1,308 @@
+import asyncio
+import logging
+import re
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+from cache_tools import normalize_question
+
+
+# keeps an LLM client per model warm and builds the tools (with their own
+# query engine) of a model the first time a request asks for it. Tools are
+# kept for the max_models most recently used models. Every agent() call hands
+# out a new agent on top of them, so concurrent chats never share a memory.
+# Nothing here touches the global Settings, so switching models never affects
+# requests in flight
+class ModelRegistry:
+    def __init__(self, build_llm, build_tools, build_agent, max_models=3):
+        self._build_llm = build_llm
+        self._build_tools = build_tools
+        self._build_agent = build_agent
+        self.max_models = max_models
+        self.default_model = None
+        self.known_models = set()
+        self.llms = {}
+        self.tools = OrderedDict()
+        self._locks = {}
+
+    def is_known(self, model_name):
+        return model_name in self.known_models
+
+    def llm(self, model_name=None):
+        model_name = model_name or self.default_model
+        if model_name not in self.llms:
+            self.llms[model_name] = self._build_llm(model_name)
+        return self.llms[model_name]
+
+    # the tools of a model, built once even if several requests ask at the same time
+    async def model_tools(self, model_name=None):
+        model_name = model_name or self.default_model
+        tools = self.tools.get(model_name)
+        if tools is not None:
+            self.tools.move_to_end(model_name)
+            return tools
+        lock = self._locks.setdefault(model_name, asyncio.Lock())
+        async with lock:
+            tools = self.tools.get(model_name)
+            if tools is None:
+                logging.info(f"building the tools for {model_name}")
+                tools = await self._build_tools(model_name, self.llm(model_name))
+                self.add_tools(model_name, tools)
+        return tools
+
+    # a new agent with an empty memory, cheap once the tools exist
+    async def agent(self, model_name=None):
+        model_name = model_name or self.default_model
+        return self._build_agent(self.llm(model_name), await self.model_tools(model_name))
+
+    def add_tools(self, model_name, tools):
+        self.tools[model_name] = tools
+        self.tools.move_to_end(model_name)
+        while len(self.tools) > self.max_models:
+            evicted, _ = self.tools.popitem(last=False)
+            logging.info(f"dropping the tools for {evicted}")
+
+    # the query engines changed underneath (new schema), the LLM clients stay warm
+    def invalidate_tools(self):
+        self.tools.clear()
+
+    def snapshot(self):
+        return {
+            "default_model": self.default_model,
+            "known_models": sorted(self.known_models),
+            "warm_llms": sorted(self.llms.keys()),
+            "models_with_tools": list(self.tools.keys()),
+        }
+
+
+# words that point at a family of tables, a question touching several of them needs joins
+QUESTION_TOPICS = {
+    "players": r"\b(players?|born|birth|died|debut|height|weight|bats|throws|names?)\b",
+    "batting": r"\b(batting|hits?|home runs?|homers?|hr|rbis?|at bats?|doubles|triples|walks|stolen bases?|average)\b",
+    "pitching": r"\b(pitch\w*|era|strikeouts?|saves?|wins|losses|innings|shutouts?|no.hitters?)\b",
+    "fielding": r"\b(field\w*|errors?|putouts?|assists?|catchers?|outfield\w*|positions?)\b",
+    "teams": r"\b(teams?|franchises?|leagues?|divisions?|parks?|attendance|standings?)\b",
+    "postseason": r"\b(post.?season|playoffs?|world series|pennants?)\b",
+    "awards": r"\b(awards?|mvp|cy young|rookie of the year|gold gloves?|all.?stars?|hall of fame)\b",
+    "salaries": r"\b(salar\w*|paid|payroll|contracts?)\b",
+    "managers": r"\b(managers?|managed)\b",
+    "schools": r"\b(colleges?|schools?|universit\w*)\b",
+}
+
+# aggregation, ranking and comparison make for bigger statements than a lookup
+QUESTION_OPERATIONS = (r"\b(average|avg|mean|total|sum|count|how many|most|least|highest|lowest|top \d+|"
+                       r"rank\w*|ratio|percent\w*|per|each|compare\w*|versus|vs|than|trend|over time|"
+                       r"by (year|decade|team|season|league)|career|cumulative|between|without|excluding)\b")
+
+
+# a rough score of how hard the SQL behind a question will be: one point per
+# extra table family, one per aggregate or comparison and one for long questions
+def question_complexity(question):
+    normalized = normalize_question(question)
+    topics = [topic for topic, pattern in QUESTION_TOPICS.items() if re.search(pattern, normalized)]
+    operations = re.findall(QUESTION_OPERATIONS, normalized)
+    score = max(0, len(topics) - 1) + len(operations) + (1 if len(normalized.split()) > 20 else 0)
+    return score, topics
+
+
+# latency and outcome of the recent requests of one model, samples older than window seconds drop out
+class ModelStats:
+    def __init__(self, window=300, max_samples=500):
+        self.window = window
+        self.samples = deque(maxlen=max_samples)
+        self.in_flight = 0
+
+    def _recent(self):
+        oldest = time.time() - self.window
+        while self.samples and self.samples[0][0] < oldest:
+            self.samples.popleft()
+        return self.samples
+
+    def record(self, latency, ok):
+        self.samples.append((time.time(), latency, ok))
+
+    def percentile(self, q):
+        latencies = sorted(latency for _, latency, ok in self._recent() if ok)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+    def error_rate(self):
+        samples = self._recent()
+        if not samples:
+            return 0.0
+        return sum(1 for _, _, ok in samples if not ok) / len(samples)
+
+    def snapshot(self):
+        p50, p95 = self.percentile(0.5), self.percentile(0.95)
+        return {
+            "requests": len(self._recent()),
+            "in_flight": self.in_flight,
+            "p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+            "p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+            "error_rate": round(self.error_rate(), 4),
+        }
+
+
+# picks the model of a request that didn't ask for one: simple questions go to
+# the small models, complex ones to the large models. Within a tier the model
+# with the lowest expected wait (p50 times the requests queued on it) wins, and
+# models that are saturated (too many requests in flight or p95 over the limit)
+# or failing (error rate over the limit) are passed over until their window
+# clears. Returns the candidates in order so callers can fall back
+class ModelRouter:
+    def __init__(self, registry: ModelRegistry, simple_models, complex_models, complexity_threshold=3,
+                 max_in_flight=4, max_p95=60.0, max_error_rate=0.5, min_samples=5, window=300):
+        self.registry = registry
+        self.simple_models = simple_models
+        self.complex_models = complex_models
+        self.complexity_threshold = complexity_threshold
+        self.max_in_flight = max_in_flight
+        self.max_p95 = max_p95
+        self.max_error_rate = max_error_rate
+        self.min_samples = min_samples
+        self.window = window
+        self.stats = {}
+
+    def _stats(self, model_name):
+        if model_name not in self.stats:
+            self.stats[model_name] = ModelStats(self.window)
+        return self.stats[model_name]
+
+    def started(self, model_name):
+        self._stats(model_name).in_flight += 1
+
+    def finished(self, model_name, latency, ok):
+        stats = self._stats(model_name)
+        stats.in_flight = max(0, stats.in_flight - 1)
+        stats.record(latency, ok)
+
+    @contextmanager
+    def track(self, model_name):
+        start = time.monotonic()
+        self.started(model_name)
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            self.finished(model_name, time.monotonic() - start, ok)
+
+    # why a model should be passed over, None if it can take the request
+    def _unavailable(self, model_name):
+        stats = self._stats(model_name)
+        if stats.in_flight >= self.max_in_flight:
+            return "saturated"
+        if len(stats._recent()) >= self.min_samples:
+            if stats.error_rate() > self.max_error_rate:
+                return "failing"
+            p95 = stats.percentile(0.95)
+            if p95 is not None and p95 > self.max_p95:
+                return "slow"
+        return None
+
+    # models without samples yet count as fast so they get measured
+    def _expected_wait(self, model_name):
+        stats = self._stats(model_name)
+        return (stats.percentile(0.5) or 0.0) * (stats.in_flight + 1)
+
+    def route(self, question):
+        score, topics = question_complexity(question)
+        tier = "complex" if score >= self.complexity_threshold else "simple"
+        preferred, other = ((self.complex_models, self.simple_models) if tier == "complex"
+                            else (self.simple_models, self.complex_models))
+        candidates, skipped = [], {}
+        for models in (preferred, other, [self.registry.default_model]):
+            available = []
+            for model_name in models:
+                if not self.registry.is_known(model_name) or model_name in candidates or model_name in skipped:
+                    continue
+                reason = self._unavailable(model_name)
+                if reason:
+                    skipped[model_name] = reason
+                else:
+                    available.append(model_name)
+            candidates.extend(sorted(available, key=self._expected_wait))
+        # everything is busy or failing, queue on the least bad ones rather than refuse
+        candidates.extend(sorted(skipped, key=self._expected_wait))
+        info = {"complexity": score, "topics": topics, "tier": tier, "skipped": skipped}
+        return candidates, info
+
+    def snapshot(self):
+        return {model_name: stats.snapshot() for model_name, stats in self.stats.items()}
+
+
+# pulls Ollama models in the background, a few at a time, over one shared
+# client and keeps the progress of every pull for /pull_status. A pulled
+# LLM can be warmed up (loaded into memory) before on_ready hears about it
+class ModelPuller:
+    def __init__(self, client, concurrency=2, keep_alive="180m", on_ready=None):
+        self.client = client
+        self.keep_alive = keep_alive
+        self.on_ready = on_ready
+        self.jobs = {}
+        self._tasks = {}
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    # the task of the pull, a model is only pulled once unless its last pull failed
+    def pull(self, model_name, warm=False):
+        task = self._tasks.get(model_name)
+        if task is not None and self.jobs[model_name]["status"] not in ("failed", "cancelled"):
+            return task
+        self.jobs[model_name] = {
+            "status": "queued",
+            "detail": "",
+            "completed": 0,
+            "total": 0,
+            "percent": 0.0,
+            "error": None,
+            "started": time.time(),
+            "finished": None,
+        }
+        task = asyncio.create_task(self._pull(model_name, warm))
+        self._tasks[model_name] = task
+        return task
+
+    async def _pull(self, model_name, warm):
+        job = self.jobs[model_name]
+        try:
+            async with self._semaphore:
+                job["status"] = "pulling"
+                logging.info(f"pulling {model_name}")
+                async for progress in await self.client.pull(model_name, stream=True):
+                    job["detail"] = progress.get("status", "")
+                    # every layer reports its own progress
+                    if progress.get("total"):
+                        job["completed"] = progress.get("completed", 0)
+                        job["total"] = progress["total"]
+                        job["percent"] = round(100 * job["completed"] / job["total"], 1)
+                if warm:
+                    job["status"] = "warming"
+                    # an empty prompt only loads the model
+                    await self.client.generate(model=model_name, prompt="", keep_alive=self.keep_alive)
+            job["status"] = "ready"
+            logging.info(f"{model_name} is ready")
+            if self.on_ready:
+                self.on_ready(model_name)
+        except asyncio.CancelledError:
+            job["status"] = "cancelled"
+            raise
+        except Exception as e:
+            job["status"] = "failed"
+            job["error"] = f"{type(e).__name__}: {e}"
+            logging.error(f"Failed to pull {model_name}: {e}")
+        finally:
+            job["finished"] = time.time()
+        return job["status"] == "ready"
+
+    def in_progress(self):
+        return [model_name for model_name, job in self.jobs.items()
+                if job["status"] in ("queued", "pulling", "warming")]
+
+    def cancel(self):
+        for task in self._tasks.values():
+            task.cancel()
+
+    def snapshot(self):
+        return {model_name: dict(job) for model_name, job in self.jobs.items()}
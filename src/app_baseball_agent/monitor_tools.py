@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import time
+
+
+# watches for anything that holds the event loop: a task that should wake up
+# every interval seconds and comes back late means something ran on the loop
+# without awaiting. The requests in flight at that moment are logged with it
+class LoopLagMonitor:
+    def __init__(self, interval=0.5, threshold=0.25):
+        self.interval = interval
+        self.threshold = threshold
+        self.in_flight = {}
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.lag_events = 0
+        self._next_request_id = 0
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def request_started(self, description):
+        self._next_request_id += 1
+        self.in_flight[self._next_request_id] = (description, time.monotonic())
+        return self._next_request_id
+
+    def request_finished(self, request_id):
+        self.in_flight.pop(request_id, None)
+
+    async def _run(self):
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = time.monotonic() - start - self.interval
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            if lag > self.threshold:
+                self.lag_events += 1
+                now = time.monotonic()
+                in_flight = ", ".join(f"{description} ({now - started:.1f}s)"
+                                      for description, started in self.in_flight.values()) or "none"
+                logging.warning(f"event loop blocked for {lag * 1000:.0f}ms, requests in flight: {in_flight}")
+
+    def snapshot(self):
+        return {
+            "last_lag_ms": round(self.last_lag * 1000, 1),
+            "max_lag_ms": round(self.max_lag * 1000, 1),
+            "lag_events": self.lag_events,
+            "threshold_ms": round(self.threshold * 1000, 1),
+            "requests_in_flight": len(self.in_flight),
+        }
+
+
+# runs the readiness checks in the background so probes only read the last
+# results. A check is an async function returning a short detail string and
+# raising when the dependency isn't usable
+class HealthProber:
+    def __init__(self, checks, interval=15, timeout=5):
+        self.checks = checks
+        self.interval = interval
+        self.timeout = timeout
+        self.results = {}
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _check(self, name, check):
+        start = time.monotonic()
+        try:
+            detail = await asyncio.wait_for(check(), self.timeout)
+            ok = True
+        except Exception as e:
+            detail = f"{type(e).__name__}: {e}"
+            ok = False
+        self.results[name] = {
+            "ok": ok,
+            "detail": str(detail),
+            "latency_ms": round((time.monotonic() - start) * 1000, 1),
+            "checked_at": time.time(),
+        }
+        if not ok:
+            logging.warning(f"readiness check {name} failed: {detail}")
+
+    async def probe(self):
+        await asyncio.gather(*[self._check(name, check) for name, check in self.checks.items()])
+
+    async def _run(self):
+        while True:
+            await self.probe()
+            await asyncio.sleep(self.interval)
+
+    # results that weren't refreshed for a few intervals don't count, the prober itself may be stuck
+    @property
+    def ready(self):
+        stale = time.time() - 3 * self.interval - self.timeout
+        return (len(self.results) == len(self.checks) and
+                all(result["ok"] and result["checked_at"] > stale for result in self.results.values()))
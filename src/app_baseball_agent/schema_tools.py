@@ -0,0 +1,206 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional
+
+import asyncpg
+
+
+NO_DESCRIPTION = "No description available"
+
+# bump whenever the layout of the cached schema changes
+SCHEMA_CACHE_VERSION = 1
+
+# one round trip for every table, column, type and comment in the schema
+# (views and materialized views included, like information_schema.tables)
+CATALOG_SQL = """
+SELECT c.relname AS table_name,
+       obj_description(c.oid, 'pg_class') AS table_comment,
+       a.attname AS column_name,
+       format_type(a.atttypid, a.atttypmod) AS data_type,
+       col_description(c.oid, a.attnum) AS column_comment
+FROM pg_class c
+JOIN pg_namespace n ON n.oid = c.relnamespace
+LEFT JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+WHERE n.nspname = $1 AND c.relkind IN ('r', 'p', 'v', 'm', 'f')
+ORDER BY c.relname, a.attnum
+"""
+
+# cheap enough to run on every start: hashes the structure (columns, types,
+# comments, relfilenode which changes on truncate) and the insert/update/delete
+# counters, so both schema changes and new ingests change the fingerprint
+FINGERPRINT_SQL = """
+SELECT md5(coalesce(string_agg(t.signature, '|' ORDER BY t.signature), '')) AS fingerprint
+FROM (
+    SELECT c.relname || ':' || c.relfilenode || ':' || coalesce(obj_description(c.oid, 'pg_class'), '') || ':' ||
+           coalesce((SELECT string_agg(a.attname || ' ' || format_type(a.atttypid, a.atttypmod) || ' ' ||
+                                       coalesce(col_description(c.oid, a.attnum), ''), ',' ORDER BY a.attnum)
+                     FROM pg_attribute a
+                     WHERE a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped), '') || ':' ||
+           (pg_stat_get_tuples_inserted(c.oid) + pg_stat_get_tuples_updated(c.oid) +
+            pg_stat_get_tuples_deleted(c.oid)) AS signature
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = $1 AND c.relkind IN ('r', 'p', 'v', 'm', 'f')
+) t
+"""
+
+
+@dataclass
+class ColumnSchema:
+    name: str
+    data_type: str
+    description: Optional[str] = None
+
+
+@dataclass
+class TableSchema:
+    name: str
+    description: str = NO_DESCRIPTION
+    columns: List[ColumnSchema] = field(default_factory=list)
+    sample_rows: List[dict] = field(default_factory=list)
+
+    @property
+    def column_names(self) -> List[str]:
+        return [column.name for column in self.columns]
+
+
+@dataclass
+class DatabaseSchema:
+    tables: Dict[str, TableSchema] = field(default_factory=dict)
+    fingerprint: Optional[str] = None
+
+    @property
+    def table_names(self) -> List[str]:
+        return list(self.tables.keys())
+
+    # changes with tables, columns, types and comments but not with the data,
+    # unlike the fingerprint which also moves with every ingest
+    @property
+    def schema_version(self) -> str:
+        digest = hashlib.sha256()
+        for name in sorted(self.tables):
+            table = self.tables[name]
+            digest.update(f"{name}|{table.description}\n".encode("utf-8"))
+            for column in table.columns:
+                digest.update(f"{column.name}|{column.data_type}|{column.description}\n".encode("utf-8"))
+        return digest.hexdigest()[:16]
+
+    # the dict shapes the query engine seed always had in app.state
+    def as_query_engine_seed(self):
+        database_schema = {
+            name: {"schema": table.column_names, "description": table.description}
+            for name, table in self.tables.items()
+        }
+        sample_data = {name: table.sample_rows for name, table in self.tables.items()}
+        return database_schema, sample_data
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "DatabaseSchema":
+        tables = {}
+        for name, table in data["tables"].items():
+            columns = [ColumnSchema(**column) for column in table["columns"]]
+            tables[name] = TableSchema(name=table["name"], description=table["description"],
+                                       columns=columns, sample_rows=table["sample_rows"])
+        return cls(tables=tables, fingerprint=data.get("fingerprint"))
+
+
+def _quote_identifier(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def tables_from_catalog(records) -> Dict[str, TableSchema]:
+    tables = {}
+    for record in records:
+        table_name = record["table_name"]
+        table = tables.get(table_name)
+        if table is None:
+            table = tables[table_name] = TableSchema(name=table_name,
+                                                     description=record["table_comment"] or NO_DESCRIPTION)
+        # tables without columns still come back once from the left join
+        if record["column_name"] is not None:
+            table.columns.append(ColumnSchema(name=record["column_name"], data_type=record["data_type"],
+                                              description=record["column_comment"]))
+    return tables
+
+
+async def _fetch_sample(pool, table: TableSchema, sample_rows: int):
+    try:
+        records = await pool.fetch(f"SELECT * FROM {_quote_identifier(table.name)} LIMIT {int(sample_rows)}")
+        table.sample_rows = [dict(record) for record in records]
+    except asyncpg.PostgresError as e:
+        # a broken view shouldn't take the whole schema down with it
+        logging.warning(f"Failed to fetch sample rows for {table.name}: {e}")
+
+
+# introspect every table of a schema: one catalog query plus the sample
+# queries running in parallel over a small pool
+async def introspect_schema(database_endpoint, schema_name="public", sample_rows=5, concurrency=5) -> DatabaseSchema:
+    pool = await asyncpg.create_pool(database_endpoint, min_size=1, max_size=max(1, concurrency))
+    try:
+        # the fingerprint is taken alongside the catalog, a change that sneaks in
+        # between the two just means we introspect again on the next check
+        catalog, fingerprint = await asyncio.gather(pool.fetch(CATALOG_SQL, schema_name),
+                                                    pool.fetchval(FINGERPRINT_SQL, schema_name))
+        tables = tables_from_catalog(catalog)
+        logging.info(f"introspected {len(tables)} tables in schema {schema_name}")
+        if sample_rows > 0:
+            await asyncio.gather(*[_fetch_sample(pool, table, sample_rows) for table in tables.values()])
+        return DatabaseSchema(tables=tables, fingerprint=fingerprint)
+    finally:
+        await pool.close()
+
+
+# on a pool (or connection) the caller keeps open, this runs every few minutes
+async def fetch_schema_fingerprint(pool, schema_name="public") -> str:
+    return await pool.fetchval(FINGERPRINT_SQL, schema_name)
+
+
+# identifies the database and settings a cached schema belongs to, without
+# keeping the connection string (and its password) on disk
+def schema_cache_key(database_endpoint, schema_name="public", sample_rows=5) -> str:
+    identity = f"{SCHEMA_CACHE_VERSION}|{database_endpoint}|{schema_name}|{sample_rows}"
+    return hashlib.sha256(identity.encode("utf-8")).hexdigest()
+
+
+def load_schema_cache(path, cache_key) -> Optional[DatabaseSchema]:
+    if not path or not os.path.isfile(path):
+        return None
+    try:
+        with open(path, "r") as f:
+            data = json.load(f)
+        if data.get("version") != SCHEMA_CACHE_VERSION or data.get("key") != cache_key:
+            logging.info(f"ignoring schema cache {path}, it was written for another database or version")
+            return None
+        return DatabaseSchema.from_dict(data["schema"])
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logging.warning(f"Failed to read schema cache {path}: {e}")
+        return None
+
+
+def save_schema_cache(path, cache_key, database_schema: DatabaseSchema):
+    if not path:
+        return
+    data = {
+        "version": SCHEMA_CACHE_VERSION,
+        "key": cache_key,
+        "created": time.time(),
+        "schema": database_schema.to_dict(),
+    }
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # write to a temp file first so other workers never read a half written cache
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            # sample rows can hold dates and decimals, the prompt only needs their text
+            json.dump(data, f, default=str)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logging.warning(f"Failed to write schema cache {path}: {e}")
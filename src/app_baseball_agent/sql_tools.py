@@ -0,0 +1,347 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from llama_index.core.schema import NodeWithScore, QueryBundle, TextNode
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from cache_tools import normalize_question
+from stream_tools import emit_event
+from trace_tools import trace_stage
+
+# the plan file is locked while it is merged, not available on Windows
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# bump whenever the layout of the persisted plans changes
+SQL_PLAN_CACHE_VERSION = 1
+
+
+# serializes the read-merge-write of the plan file across workers, where flock exists
+@contextmanager
+def _file_lock(path):
+    if fcntl is None:
+        yield
+        return
+    with open(f"{path}.lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+# generated SQL keyed by the normalized question, the schema version and the
+# model that wrote it. Bounded with LRU eviction, optionally kept on disk.
+# Changes are written save_delay seconds after the first one, from a timer
+# thread, and merged into the file so workers sharing it keep each other's plans
+class SQLPlanCache:
+    def __init__(self, max_entries=1024, path=None, save_delay=5):
+        self.max_entries = max_entries
+        self.path = path
+        self.save_delay = save_delay
+        self.hits = 0
+        self.misses = 0
+        # the plans put (or discarded, None) since the last save
+        self._changes = OrderedDict()
+        self._timer = None
+        self._lock = threading.Lock()
+        self.plans = self._read()
+        if self.plans:
+            logging.info(f"loaded {len(self.plans)} sql plans from {path}")
+
+    def _read(self):
+        if not self.path or not os.path.isfile(self.path):
+            return OrderedDict()
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            if data.get("version") == SQL_PLAN_CACHE_VERSION:
+                return OrderedDict(data.get("plans", []))
+        except (OSError, ValueError) as e:
+            logging.warning(f"Failed to read sql plan cache {self.path}: {e}")
+        return OrderedDict()
+
+    @staticmethod
+    def key(question, schema_version, model):
+        identity = f"{schema_version}|{model}|{normalize_question(question)}"
+        return hashlib.sha256(identity.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            sql = self.plans.get(key)
+            if sql is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.plans.move_to_end(key)
+            return sql
+
+    def put(self, key, sql):
+        with self._lock:
+            self.plans[key] = sql
+            self.plans.move_to_end(key)
+            while len(self.plans) > self.max_entries:
+                self.plans.popitem(last=False)
+            self._changed(key, sql)
+
+    def discard(self, key):
+        with self._lock:
+            if self.plans.pop(key, None) is not None:
+                self._changed(key, None)
+
+    def _changed(self, key, sql):
+        if not self.path:
+            return
+        self._changes[key] = sql
+        self._changes.move_to_end(key)
+        if self._timer is None:
+            self._timer = threading.Timer(self.save_delay, self.save)
+            self._timer.daemon = True
+            self._timer.start()
+
+    # writes the pending changes now, on shutdown
+    def flush(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+        self.save()
+
+    def save(self):
+        with self._lock:
+            changes, self._changes = self._changes, OrderedDict()
+            self._timer = None
+        if not changes:
+            return
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with _file_lock(self.path):
+                plans = self._read()
+                for key, sql in changes.items():
+                    plans.pop(key, None)
+                    if sql is not None:
+                        plans[key] = sql
+                while len(plans) > self.max_entries:
+                    plans.popitem(last=False)
+                tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump({"version": SQL_PLAN_CACHE_VERSION, "plans": list(plans.items())}, f)
+                os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.warning(f"Failed to write sql plan cache {self.path}: {e}")
+            return
+        # pick up what the other workers wrote, unless it changed here in the meantime
+        with self._lock:
+            for key, sql in reversed(plans.items()):
+                if key not in self.plans and key not in self._changes:
+                    self.plans[key] = sql
+                    self.plans.move_to_end(key, last=False)
+            while len(self.plans) > self.max_entries:
+                self.plans.popitem(last=False)
+
+
+# runs the generated SQL on an asyncpg backed engine instead of the sync one
+# SQLDatabase uses: a bounded pool, a statement timeout and read only
+# transactions on every connection, a cap on the queries running at once and
+# a server side cursor that stops after max_rows, so one runaway
+# SELECT * over pitching_csv neither blocks the loop nor eats all connections
+class AsyncSQLExecutor:
+    def __init__(self, database_endpoint, pool_size=5, max_overflow=5, pool_timeout=10,
+                 statement_timeout_ms=30000, max_rows=1000, max_concurrency=8, max_string_length=300):
+        url = make_url(database_endpoint).set(drivername="postgresql+asyncpg")
+        # asyncpg takes ssl instead of libpq's sslmode
+        if "sslmode" in url.query:
+            url = url.update_query_dict({"ssl": url.query["sslmode"]}).difference_update_query(["sslmode"])
+        self.engine = create_async_engine(
+            url,
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            pool_timeout=pool_timeout,
+            pool_pre_ping=True,
+            connect_args={"server_settings": {
+                "statement_timeout": str(statement_timeout_ms),
+                "default_transaction_read_only": "on",
+            }},
+        )
+        self.max_rows = max_rows
+        self.max_string_length = max_string_length
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    def _truncate(self, value):
+        if isinstance(value, str) and len(value) > self.max_string_length:
+            return value[:self.max_string_length - 3] + "..."
+        return value
+
+    # same result shape as SQLDatabase.run_sql
+    async def run_sql(self, command):
+        async with self._semaphore:
+            async with self.engine.connect() as conn:
+                result = await conn.stream(text(command))
+                try:
+                    col_keys = list(result.keys())
+                    rows = await result.fetchmany(self.max_rows + 1)
+                finally:
+                    await result.close()
+        truncated = len(rows) > self.max_rows
+        results = [tuple(self._truncate(column) for column in row) for row in rows[:self.max_rows]]
+        raw = str(results)
+        if truncated:
+            raw += f"\n(only the first {self.max_rows} rows are shown)"
+        return raw, {"result": results, "col_keys": col_keys, "truncated": truncated}
+
+    async def dispose(self):
+        await self.engine.dispose()
+
+
+def _model_name(llm):
+    return str(getattr(llm, "model", None) or type(llm).__name__)
+
+
+# stands in for the NLSQLRetriever of a query engine. Same table context,
+# prompt and parser as the wrapped retriever, but the generated SQL is cached
+# so a repeated question goes straight to the database without the LLM hop.
+# Only SQL that ran without an error is cached, and a cached plan that fails
+# (say after a column was renamed) is dropped and generated again
+class CachedSQLRetriever:
+    def __init__(self, retriever, plan_cache: SQLPlanCache, schema_version, executor: AsyncSQLExecutor = None):
+        self._retriever = retriever
+        self._plan_cache = plan_cache
+        self._schema_version = schema_version
+        self._executor = executor
+
+    def __getattr__(self, name):
+        return getattr(self._retriever, name)
+
+    def _plan_key(self, query_bundle):
+        return self._plan_cache.key(query_bundle.query_str, self._schema_version, _model_name(self._retriever._llm))
+
+    def _parse(self, response_str, query_bundle):
+        sql_query_str = self._retriever._sql_parser.parse_response_to_sql(response_str, query_bundle)
+        logging.debug(f"> Predicted SQL query: {sql_query_str}")
+        return sql_query_str
+
+    def _generate_sql(self, query_bundle):
+        with trace_stage("sql_generation", model=_model_name(self._retriever._llm)):
+            table_desc_str = self._retriever._get_table_context(query_bundle)
+            response_str = self._retriever._llm.predict(
+                self._retriever._text_to_sql_prompt,
+                query_str=query_bundle.query_str,
+                schema=table_desc_str,
+                dialect=self._retriever._sql_database.dialect,
+            )
+            return self._parse(response_str, query_bundle)
+
+    async def _agenerate_sql(self, query_bundle):
+        with trace_stage("sql_generation", model=_model_name(self._retriever._llm)):
+            # the table context comes from the sqlalchemy inspector, keep it off the event loop
+            table_desc_str = await asyncio.to_thread(self._retriever._get_table_context, query_bundle)
+            response_str = await self._retriever._llm.apredict(
+                self._retriever._text_to_sql_prompt,
+                query_str=query_bundle.query_str,
+                schema=table_desc_str,
+                dialect=self._retriever._sql_database.dialect,
+            )
+            return self._parse(response_str, query_bundle)
+
+    def _run_sql(self, sql_query_str, plan):
+        with trace_stage("sql_execution", **{"db.system": "postgresql", "db.statement": sql_query_str,
+                                             "sql_plan_cache": plan}) as stage:
+            nodes, metadata = self._retriever._sql_retriever.retrieve_with_metadata(sql_query_str)
+            stage.count("rows", len(metadata.get("result", [])))
+            return nodes, metadata
+
+    async def _arun_sql(self, sql_query_str, plan):
+        with trace_stage("sql_execution", **{"db.system": "postgresql", "db.statement": sql_query_str,
+                                             "sql_plan_cache": plan}) as stage:
+            nodes, metadata = await self._arun_sql_query(sql_query_str)
+            stage.count("rows", len(metadata.get("result", [])))
+            if metadata.get("truncated"):
+                stage.set("truncated", True)
+            return nodes, metadata
+
+    # SQLRetriever only pretends to be async, without an executor its queries run on the sync engine
+    async def _arun_sql_query(self, sql_query_str):
+        if self._executor is None:
+            return await asyncio.to_thread(self._retriever._sql_retriever.retrieve_with_metadata, sql_query_str)
+        raw_response_str, metadata = await self._executor.run_sql(sql_query_str)
+        sql_retriever = self._retriever._sql_retriever
+        if not sql_retriever._return_raw:
+            return sql_retriever._format_node_results(metadata["result"], metadata["col_keys"]), metadata
+        node = TextNode(
+            text=raw_response_str,
+            metadata={"sql_query": sql_query_str, "result": metadata["result"], "col_keys": metadata["col_keys"]},
+            excluded_embed_metadata_keys=["sql_query", "result", "col_keys"],
+            excluded_llm_metadata_keys=["sql_query", "result", "col_keys"],
+        )
+        return [NodeWithScore(node=node)], metadata
+
+    # lets a streaming request show the SQL and the size of the result before the answer
+    def _emit_result(self, sql_query_str, plan, metadata):
+        emit_event("sql", sql=sql_query_str, plan_cache=plan)
+        if "result" in metadata:
+            emit_event("rows", count=len(metadata["result"]), columns=metadata.get("col_keys", []))
+
+    def _error_result(self, e):
+        if not self._retriever._handle_sql_errors:
+            raise e
+        return [NodeWithScore(node=TextNode(text=f"Error: {e!s}"))], {}
+
+    def retrieve_with_metadata(self, str_or_query_bundle):
+        query_bundle = QueryBundle(str_or_query_bundle) if isinstance(str_or_query_bundle, str) else str_or_query_bundle
+        key = self._plan_key(query_bundle)
+        sql_query_str = self._plan_cache.get(key)
+        if sql_query_str is not None:
+            try:
+                nodes, metadata = self._run_sql(sql_query_str, "hit")
+                self._emit_result(sql_query_str, "hit", metadata)
+                return nodes, {"sql_query": sql_query_str, "sql_plan_cache": "hit", **metadata}
+            except Exception as e:
+                logging.warning(f"Cached sql plan failed, generating a new one: {e}")
+                self._plan_cache.discard(key)
+
+        sql_query_str = self._generate_sql(query_bundle)
+        try:
+            nodes, metadata = self._run_sql(sql_query_str, "miss")
+            self._plan_cache.put(key, sql_query_str)
+        except Exception as e:
+            nodes, metadata = self._error_result(e)
+        self._emit_result(sql_query_str, "miss", metadata)
+        return nodes, {"sql_query": sql_query_str, "sql_plan_cache": "miss", **metadata}
+
+    async def aretrieve_with_metadata(self, str_or_query_bundle):
+        query_bundle = QueryBundle(str_or_query_bundle) if isinstance(str_or_query_bundle, str) else str_or_query_bundle
+        key = self._plan_key(query_bundle)
+        sql_query_str = self._plan_cache.get(key)
+        if sql_query_str is not None:
+            try:
+                nodes, metadata = await self._arun_sql(sql_query_str, "hit")
+                self._emit_result(sql_query_str, "hit", metadata)
+                return nodes, {"sql_query": sql_query_str, "sql_plan_cache": "hit", **metadata}
+            except Exception as e:
+                logging.warning(f"Cached sql plan failed, generating a new one: {e}")
+                self._plan_cache.discard(key)
+
+        sql_query_str = await self._agenerate_sql(query_bundle)
+        try:
+            nodes, metadata = await self._arun_sql(sql_query_str, "miss")
+            self._plan_cache.put(key, sql_query_str)
+        except Exception as e:
+            nodes, metadata = self._error_result(e)
+        self._emit_result(sql_query_str, "miss", metadata)
+        return nodes, {"sql_query": sql_query_str, "sql_plan_cache": "miss", **metadata}
+
+    def retrieve(self, str_or_query_bundle):
+        return self.retrieve_with_metadata(str_or_query_bundle)[0]
+
+    async def aretrieve(self, str_or_query_bundle):
+        return (await self.aretrieve_with_metadata(str_or_query_bundle))[0]
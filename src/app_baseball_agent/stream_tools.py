@@ -0,0 +1,94 @@
+import asyncio
+import contextvars
+import json
+import logging
+import time
+
+from llama_index.core.instrumentation.event_handlers import BaseEventHandler
+from llama_index.core.instrumentation.events.agent import AgentToolCallEvent
+
+
+# the sink of the request that is streaming, if any. Tasks started by the
+# agent copy the context, so events raised deep inside a tool find it too
+_event_sink = contextvars.ContextVar("stream_event_sink", default=None)
+
+
+class StreamEventSink:
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+
+    def emit(self, event, **data):
+        item = (event, data)
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        # sync tools can run on a worker thread
+        if running_loop is self.loop:
+            self.queue.put_nowait(item)
+        else:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+
+    def close(self):
+        self.emit("close")
+
+
+# no-op unless the current request streams
+def emit_event(event, **data):
+    sink = _event_sink.get()
+    if sink is not None:
+        sink.emit(event, **data)
+
+
+# forwards the tool calls of any agent to the streaming request they belong to
+class ToolCallEventHandler(BaseEventHandler):
+    @classmethod
+    def class_name(cls) -> str:
+        return "ToolCallEventHandler"
+
+    def handle(self, event, **kwargs):
+        if isinstance(event, AgentToolCallEvent):
+            emit_event("tool_call", tool=event.tool.name, arguments=event.arguments)
+
+
+def sse_event(event, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+# runs agent.astream_chat in its own task and yields (event, data) tuples as
+# they happen: tool calls, sql and rows from the query engine, then the tokens
+# of the answer and finally "done" with the whole response
+async def stream_agent_events(agent, message):
+    sink = StreamEventSink()
+
+    async def produce():
+        _event_sink.set(sink)
+        start = time.time()
+        try:
+            response = await agent.astream_chat(message)
+            first_token = None
+            async for token in response.async_response_gen():
+                if first_token is None:
+                    first_token = time.time() - start
+                sink.emit("token", text=token)
+            sink.emit("done", response=str(response.response),
+                      first_token_time=f"{(first_token or time.time() - start):.2f}",
+                      inference_time=f"{time.time() - start:.2f}")
+        except Exception as e:
+            logging.error(f"Streaming inference failed: {e}")
+            sink.emit("error", detail=str(e))
+        finally:
+            sink.close()
+
+    task = asyncio.create_task(produce())
+    try:
+        while True:
+            event, data = await sink.queue.get()
+            if event == "close":
+                break
+            yield event, data
+    finally:
+        # the client went away, stop working on the answer
+        if not task.done():
+            task.cancel()
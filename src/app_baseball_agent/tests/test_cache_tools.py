@@ -0,0 +1,63 @@
+# A cached answer is only reused for a question about the same years, numbers and names
+#
+#   cd src/app_baseball_agent && python -m pytest tests
+
+import asyncio
+import os
+import re
+import sys
+
+import pytest
+
+pytest.importorskip("numpy")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from cache_tools import SemanticCache, literal_tokens
+
+
+# embeds the words of a question and ignores its digits, so questions that
+# only differ in a year get the same embedding, as they nearly do for real
+class WordEmbedding:
+    vocabulary = ["who", "hit", "the", "most", "home", "runs", "in", "wins", "pitcher"]
+
+    async def aget_query_embedding(self, question):
+        words = re.findall(r"[a-z]+", question.lower())
+        return [float(words.count(word)) + 0.01 for word in self.vocabulary]
+
+
+def _ask(cache, question):
+    return asyncio.run(cache.get("model", question, WordEmbedding()))
+
+
+def test_literal_tokens():
+    assert literal_tokens("Who hit the most home runs in 1998?") == {"1998"}
+    assert literal_tokens("In 1998, who hit the most home runs") == {"1998"}
+    assert literal_tokens("How many games did Babe Ruth play?") == {"babe", "ruth"}
+    assert literal_tokens("What did 'Hank Aaron' hit in 1974?") == {"hank aaron", "1974"}
+
+
+def test_semantic_hit_needs_the_same_literals():
+    cache = SemanticCache(similarity_threshold=0.9)
+    _, info, embedding = _ask(cache, "Who hit the most home runs in 1998?")
+    assert info["status"] == "miss"
+    cache.put("model", "Who hit the most home runs in 1998?", "Mark McGwire, 70", {"omodel_name": "model"},
+              embedding)
+
+    entry, info, _ = _ask(cache, "Who hit the most home runs in 1999?")
+    assert entry is None
+    assert info["status"] == "miss"
+
+    entry, info, _ = _ask(cache, "In 1998, who hit the most home runs")
+    assert info["status"] == "semantic"
+    assert entry.response == "Mark McGwire, 70"
+
+
+def test_put_keeps_a_copy_of_the_metadata():
+    cache = SemanticCache()
+    metadata = {"omodel_name": "model", "route": {"reason": "default"}}
+    cache.put("model", "Who hit the most home runs in 1998?", "Mark McGwire, 70", metadata)
+    metadata["stages"] = {}
+    metadata["route"]["reason"] = "changed"
+
+    entry, _, _ = _ask(cache, "who hit the most home runs in 1998")
+    assert entry.metadata == {"omodel_name": "model", "route": {"reason": "default"}}
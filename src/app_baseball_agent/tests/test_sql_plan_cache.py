@@ -0,0 +1,87 @@
+# Workers sharing SQL_PLAN_CACHE_PATH keep each other's plans
+#
+#   cd src/app_baseball_agent && python -m pytest tests
+
+import json
+import os
+import sys
+import threading
+
+import pytest
+
+pytest.importorskip("llama_index.core")
+pytest.importorskip("sqlalchemy.ext.asyncio")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from sql_tools import SQLPlanCache
+
+
+def _saved_plans(path):
+    with open(path) as f:
+        return dict(json.load(f)["plans"])
+
+
+def test_put_is_saved_later_in_one_batch(tmp_path):
+    path = str(tmp_path / "plans.json")
+    cache = SQLPlanCache(path=path, save_delay=60)
+    cache.put("a", "SELECT 1")
+    cache.put("b", "SELECT 2")
+    assert not os.path.exists(path)
+    cache.flush()
+    assert _saved_plans(path) == {"a": "SELECT 1", "b": "SELECT 2"}
+
+
+def test_concurrent_writers_keep_all_plans(tmp_path):
+    path = str(tmp_path / "plans.json")
+    workers = [SQLPlanCache(path=path, save_delay=60) for _ in range(4)]
+    for n, cache in enumerate(workers):
+        for i in range(25):
+            cache.put(f"{n}-{i}", f"SELECT {n}, {i}")
+
+    start = threading.Barrier(len(workers))
+
+    def flush(cache):
+        start.wait()
+        cache.flush()
+
+    threads = [threading.Thread(target=flush, args=(cache,)) for cache in workers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    plans = _saved_plans(path)
+    assert len(plans) == 100
+    assert plans["3-24"] == "SELECT 3, 24"
+    # and a restarted worker loads all of them
+    assert SQLPlanCache(path=path).get("0-0") == "SELECT 0, 0"
+
+
+def test_discarded_plan_isnt_merged_back(tmp_path):
+    path = str(tmp_path / "plans.json")
+    first = SQLPlanCache(path=path, save_delay=60)
+    first.put("a", "SELECT broken")
+    first.flush()
+
+    second = SQLPlanCache(path=path, save_delay=60)
+    second.discard("a")
+    second.put("b", "SELECT 2")
+    second.flush()
+    # the first worker still has it in memory, only its own changes are merged
+    first.put("c", "SELECT 3")
+    first.flush()
+
+    assert _saved_plans(path) == {"b": "SELECT 2", "c": "SELECT 3"}
+
+
+def test_eviction_keeps_the_newest_plans(tmp_path):
+    path = str(tmp_path / "plans.json")
+    first = SQLPlanCache(max_entries=2, path=path, save_delay=60)
+    first.put("a", "SELECT 1")
+    first.flush()
+    second = SQLPlanCache(max_entries=2, path=path, save_delay=60)
+    second.put("b", "SELECT 2")
+    second.put("c", "SELECT 3")
+    second.flush()
+
+    assert _saved_plans(path) == {"b": "SELECT 2", "c": "SELECT 3"}
@@ -0,0 +1,259 @@
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from llama_index.core.instrumentation.event_handlers import BaseEventHandler
+from llama_index.core.instrumentation.events.agent import (AgentRunStepEndEvent, AgentRunStepStartEvent,
+                                                           AgentToolCallEvent)
+from llama_index.core.instrumentation.events.llm import (LLMChatEndEvent, LLMChatStartEvent,
+                                                         LLMCompletionEndEvent, LLMCompletionStartEvent)
+from llama_index.core.tools import QueryEngineTool
+from llama_index.core.tools.eval_query_engine import EvalQueryEngineTool
+from opentelemetry import context as otel_context
+from opentelemetry import trace
+from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor
+
+
+_tracer = None
+
+# the breakdown of the request being answered and the stages it is in right
+# now. Tasks and worker threads started by the agent copy the context
+_breakdown = contextvars.ContextVar("stage_breakdown", default=None)
+_stages = contextvars.ContextVar("stage_stack", default=())
+# the LLM call in progress. A chat can be served by a completion underneath,
+# only the outermost call is timed and counted
+_llm_call = contextvars.ContextVar("llm_call", default=None)
+
+# the stages an LLM call belongs to when it isn't made inside a timed stage:
+# calls of the agent itself plan the next step, calls inside a tool write the answer
+_PLANNING_STAGES = (None, "agent", "agent_step")
+_TOOL_STAGES = ("tool_call",)
+
+
+# exports spans over OTLP/HTTP to OTEL_EXPORTER_OTLP_ENDPOINT (read by the exporter)
+def setup_tracing(service_name):
+    global _tracer
+    provider = TracerProvider(resource=Resource.create({"service.name": service_name}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    trace.set_tracer_provider(provider)
+    _tracer = trace.get_tracer(service_name)
+    logging.info(f"exporting traces of {service_name} over OTLP")
+    return True
+
+
+def shutdown_tracing():
+    if _tracer is not None:
+        trace.get_tracer_provider().shutdown()
+
+
+# time, count and counters (rows, tokens) per stage of one request. Stages
+# nest, a tool call includes the SQL it ran, so they don't add up to the total
+class StageBreakdown:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.open_spans = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds=None, **counters):
+        with self._lock:
+            stage = self.stages.setdefault(name, {"count": 0, "ms": 0.0})
+            if seconds is not None:
+                stage["count"] += 1
+                stage["ms"] += seconds * 1000
+            for key, value in counters.items():
+                stage[key] = stage.get(key, 0) + value
+
+    def snapshot(self):
+        with self._lock:
+            stages = {name: {**stage, "ms": round(stage["ms"], 1)} for name, stage in self.stages.items()}
+        return {"total_ms": round((time.perf_counter() - self.started) * 1000, 1), "stages": stages}
+
+
+class Stage:
+    def __init__(self, name, span):
+        self.name = name
+        self.span = span
+        self.counters = {}
+
+    def set(self, key, value):
+        if self.span is not None:
+            self.span.set_attribute(key, value)
+
+    # summed up per stage in the breakdown as well
+    def count(self, key, value):
+        self.counters[key] = self.counters.get(key, 0) + value
+        self.set(key, self.counters[key])
+
+
+def _attributes(attributes):
+    return {key: value if isinstance(value, (str, bool, int, float)) else str(value)
+            for key, value in attributes.items() if value is not None}
+
+
+@contextmanager
+def _span(name, attributes):
+    if _tracer is None:
+        yield None
+        return
+    with _tracer.start_as_current_span(name, attributes=_attributes(attributes)) as span:
+        yield span
+
+
+# the root of a request, everything traced inside adds to the breakdown it yields
+@contextmanager
+def trace_request(name, **attributes):
+    breakdown = StageBreakdown()
+    token = _breakdown.set(breakdown)
+    try:
+        with _span(name, attributes):
+            yield breakdown
+    finally:
+        # an agent step that failed never sent its end event
+        for opened in breakdown.open_spans.values():
+            if opened["span"] is not None:
+                opened["span"].end()
+        _breakdown.reset(token)
+
+
+# one timed stage of the current request, a span of its own when tracing is on
+@contextmanager
+def trace_stage(name, **attributes):
+    token = _stages.set(_stages.get() + (name,))
+    start = time.perf_counter()
+    try:
+        with _span(name, attributes) as span:
+            stage = Stage(name, span)
+            yield stage
+    finally:
+        _stages.reset(token)
+        breakdown = _breakdown.get()
+        if breakdown is not None:
+            breakdown.add(name, time.perf_counter() - start, **stage.counters)
+
+
+def token_usage(response):
+    raw = getattr(response, "raw", None)
+    if raw is None:
+        return {}
+    usage = raw.get("usage") if isinstance(raw, dict) else getattr(raw, "usage", None)
+    if usage is not None:
+        get = usage.get if isinstance(usage, dict) else lambda key: getattr(usage, key, None)
+        return {"prompt_tokens": get("prompt_tokens") or 0, "completion_tokens": get("completion_tokens") or 0}
+    # Ollama reports its counts on the response itself
+    if isinstance(raw, dict) and "eval_count" in raw:
+        return {"prompt_tokens": raw.get("prompt_eval_count") or 0, "completion_tokens": raw.get("eval_count") or 0}
+    return {}
+
+
+# turns the llama_index events of the agent into spans and stages: agent steps,
+# tool calls and LLM calls with their token counts. An LLM call counts towards
+# the stage it was made in (sql_generation, evaluation), otherwise towards
+# llm_planning for the agent or synthesis inside a tool. Start and end events
+# of a step or call arrive in the same context, so the span and the stage are
+# made current in between
+class TraceEventHandler(BaseEventHandler):
+    @classmethod
+    def class_name(cls) -> str:
+        return "TraceEventHandler"
+
+    def _open(self, breakdown, key, name, attributes, stage=None):
+        opened = {"start": time.perf_counter(), "span": None, "context_token": None, "stage_token": None}
+        if _tracer is not None:
+            opened["span"] = _tracer.start_span(name, attributes=_attributes(attributes))
+            opened["context_token"] = otel_context.attach(trace.set_span_in_context(opened["span"]))
+        if stage is not None:
+            opened["stage_token"] = _stages.set(_stages.get() + (stage,))
+        breakdown.open_spans[key] = opened
+
+    def _close(self, breakdown, key, attributes=None):
+        opened = breakdown.open_spans.pop(key, None)
+        if opened is None:
+            return None
+        try:
+            if opened["stage_token"] is not None:
+                _stages.reset(opened["stage_token"])
+            if opened["context_token"] is not None:
+                otel_context.detach(opened["context_token"])
+        except ValueError:
+            pass
+        if opened["span"] is not None:
+            for name, value in _attributes(attributes or {}).items():
+                opened["span"].set_attribute(name, value)
+            opened["span"].end()
+        return time.perf_counter() - opened["start"]
+
+    def handle(self, event, **kwargs):
+        breakdown = _breakdown.get()
+        if breakdown is None:
+            return
+        if isinstance(event, AgentRunStepStartEvent):
+            self._open(breakdown, ("agent_step", event.span_id), "agent_step",
+                       {"task_id": event.task_id}, stage="agent_step")
+        elif isinstance(event, AgentRunStepEndEvent):
+            seconds = self._close(breakdown, ("agent_step", event.span_id))
+            if seconds is not None:
+                breakdown.add("agent_step", seconds)
+        elif isinstance(event, AgentToolCallEvent):
+            if _tracer is not None:
+                trace.get_current_span().add_event("tool_call", {"tool": event.tool.name,
+                                                                 "arguments": event.arguments})
+        elif isinstance(event, (LLMChatStartEvent, LLMCompletionStartEvent)):
+            call = _llm_call.get()
+            if call is not None:
+                call["depth"] += 1
+                return
+            call = {"key": ("llm", event.span_id, threading.get_ident()), "depth": 0, "usage": {}}
+            call["token"] = _llm_call.set(call)
+            self._open(breakdown, call["key"], "llm", {"llm.model": event.model_dict.get("model")})
+        elif isinstance(event, (LLMChatEndEvent, LLMCompletionEndEvent)):
+            call = _llm_call.get()
+            if call is None:
+                return
+            call["usage"] = token_usage(event.response) or call["usage"]
+            if call["depth"] > 0:
+                call["depth"] -= 1
+                return
+            try:
+                _llm_call.reset(call["token"])
+            except ValueError:
+                pass
+            usage = call["usage"]
+            seconds = self._close(breakdown, call["key"], usage)
+            if seconds is None:
+                return
+            stages = _stages.get()
+            owner = stages[-1] if stages else None
+            if owner in _PLANNING_STAGES:
+                breakdown.add("llm_planning", seconds, **usage)
+            elif owner in _TOOL_STAGES:
+                breakdown.add("synthesis", seconds, **usage)
+            else:
+                # the stage itself is timed already
+                breakdown.add(owner, **usage)
+
+
+# EvalQueryEngineTool with the tool call and the RelevancyEvaluator as stages of their own
+class TracedEvalQueryEngineTool(EvalQueryEngineTool):
+    def call(self, *args, **kwargs):
+        with trace_stage("tool_call", tool=self.metadata.name):
+            tool_output = QueryEngineTool.call(self, *args, **kwargs)
+            with trace_stage("evaluation"):
+                evaluation_results = self._evaluator.evaluate_response(
+                    tool_output.raw_input["input"], tool_output.raw_output
+                )
+            return self._process_tool_output(tool_output, evaluation_results)
+
+    async def acall(self, *args, **kwargs):
+        with trace_stage("tool_call", tool=self.metadata.name):
+            tool_output = await QueryEngineTool.acall(self, *args, **kwargs)
+            with trace_stage("evaluation"):
+                evaluation_results = await self._evaluator.aevaluate_response(
+                    tool_output.raw_input["input"], tool_output.raw_output
+                )
+            return self._process_tool_output(tool_output, evaluation_results)
@@ -3,7 +3,7 @@
 import os
 
 from llama_index.core.query_engine import NLSQLTableQueryEngine
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine
 
 from llama_index.core import SQLDatabase
 #from llama_index.llms.openai import OpenAI
@@ -56,32 +56,42 @@ sample_data = {
 }
 """
 
-async def assemble_query_engine_seed():
-    # Connect to the database
-    conn = await asyncpg.connect(DATABASE_ENDPOINT)
-
-    # Get the table names
-    table_names = await conn.fetch("SELECT table_name FROM information_schema.tables WHERE table_schema='public'")
-    logging.info(f"table_names: {table_names}")
-
-    # Get the column names for each table
-    database_schema = {}
-    sample_data = {}
-    for table in table_names:
-        table_name = table["table_name"]
-        logging.info(f"fetching schema for table_name: {table_name}")
-        database_schema[table_name] = {}
-        column_names = await conn.fetch(f"SELECT column_name FROM information_schema.columns WHERE table_name='{table_name}'")
-        database_schema[table_name]["schema"] = [column["column_name"] for column in column_names]
-        table_description = await conn.fetch(f"SELECT obj_description(relfilenode, 'pg_class') AS table_comment FROM pg_class WHERE relname = '{table_name}' AND relnamespace = (SELECT oid FROM pg_namespace WHERE nspname = 'public');")
-        if table_description:
-            database_schema[table_name]["description"] = table_description[0]["table_comment"]
-        else:
-            database_schema[table_name]["description"] = "No description available"
-        sample_data[table_name] = await conn.fetch(str(text(f'SELECT * FROM "{table_name}" LIMIT 5')))
-
-    # Close the database connection
-    await conn.close()
+# all tables, columns and comments of the public schema in a single round trip
+CATALOG_SQL = """
+SELECT c.relname AS table_name,
+       obj_description(c.oid, 'pg_class') AS table_comment,
+       a.attname AS column_name
+FROM pg_class c
+JOIN pg_namespace n ON n.oid = c.relnamespace
+LEFT JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+WHERE n.nspname = 'public' AND c.relkind IN ('r', 'p', 'v', 'm', 'f')
+ORDER BY c.relname, a.attnum
+"""
+
+
+async def assemble_query_engine_seed(sample_rows=5, concurrency=5):
+    # a small pool so the sample queries can run at the same time
+    pool = await asyncpg.create_pool(DATABASE_ENDPOINT, min_size=1, max_size=concurrency)
+    try:
+        database_schema = {}
+        for record in await pool.fetch(CATALOG_SQL):
+            table_name = record["table_name"]
+            if table_name not in database_schema:
+                logging.info(f"fetching schema for table_name: {table_name}")
+                database_schema[table_name] = {
+                    "schema": [],
+                    "description": record["table_comment"] or "No description available"
+                }
+            if record["column_name"] is not None:
+                database_schema[table_name]["schema"].append(record["column_name"])
+
+        table_names = list(database_schema.keys())
+        samples = await asyncio.gather(*[
+            pool.fetch(f'SELECT * FROM "{table_name}" LIMIT {sample_rows}') for table_name in table_names
+        ])
+        sample_data = dict(zip(table_names, samples))
+    finally:
+        await pool.close()
     print(f"database_schema: {database_schema}")
     print(f"sample_data: {sample_data}")
     return database_schema, sample_data
@@ -1,7 +1,11 @@
 import azure.functions as func
 import azure.durable_functions as df
-from datetime import datetime
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+import asyncio
 import json
+import time
+import typing
 import logging
 import os
 import io
@@ -9,22 +13,55 @@ import json
 from azure.core.credentials import AzureKeyCredential
 #from azure.search.documents import SearchClient
 #from uuid import uuid16
-from sqlalchemy import create_engine, MetaData, Table, Column, String, Integer
-from sqlalchemy.dialects.postgresql import VARCHAR
-import pandas as pd
-import numpy as np
+from sqlalchemy import create_engine, text, MetaData, Table, Column, BigInteger, Date, Float, Numeric, Integer, Text
+from sqlalchemy.dialects.postgresql import DOUBLE_PRECISION
 from sqlalchemy.engine import reflection
 from azure.identity import DefaultAzureCredential
 from azure.storage.blob import BlobServiceClient
-from io import BytesIO
+from ingest_helpers import (SAMPLE_BYTES, TYPE_SAMPLE_BYTES, estimate_row_bytes, plan_byte_ranges, iter_range_lines,
+                            iter_csv_rows, infer_column_types, copy_record_batches, iter_csv_record_batches,
+                            LatencyMetrics, AdaptiveConcurrency, PG_TYPES, column_type_from_pg, convert_rows,
+                            parse_single_line_message, detect_format, iter_decompressed, iter_lines, skip_header,
+                            RangeReader, open_parquet, parquet_column_types, iter_parquet_record_batches)
 
 # TODO should this be replaced with psycopg2 (sync) to make things easier?
 import asyncpg
 
 logging.basicConfig(level=logging.DEBUG)
 
+# approximate number of rows per activity, the orchestrator turns this into byte ranges
 BATCH_SIZE = int(os.getenv("BATCH_SIZE", 1000))
+# each COPY holds at most SUB_BATCH_SIZE rows and roughly SUB_BATCH_BYTES of csv
 SUB_BATCH_SIZE = int(os.getenv("SUB_BATCH_SIZE", 100))
+SUB_BATCH_BYTES = int(os.getenv("SUB_BATCH_BYTES", 1024 * 1024))
+# how many batches of a file run in parallel, scaled down when COPY latency rises
+# (host.json maxConcurrentActivityFunctions caps the activities per worker)
+INGEST_CONCURRENCY = int(os.getenv("INGEST_CONCURRENCY", 8))
+INGEST_BACKPRESSURE_FACTOR = float(os.getenv("INGEST_BACKPRESSURE_FACTOR", 2.0))
+# tables whose batches have to be inserted one after the other in file order
+INGEST_ORDERED_TABLES = [t.strip() for t in os.getenv("INGEST_ORDERED_TABLES", "").split(",") if t.strip()]
+# failed batches are retried by the durable framework, the ledger makes the retries safe
+INGEST_MAX_ATTEMPTS = int(os.getenv("INGEST_MAX_ATTEMPTS", 5))
+INGEST_RETRY_INTERVAL_MS = int(os.getenv("INGEST_RETRY_INTERVAL_MS", 5000))
+
+# every committed batch gets a row in the ledger, in the same transaction as its COPY
+# it lives outside of the public schema so the agent doesn't pick it up as a table
+LEDGER_SCHEMA_SQL = [
+    "CREATE SCHEMA IF NOT EXISTS ingest",
+    """CREATE TABLE IF NOT EXISTS ingest.batch_ledger (
+        ingest_id TEXT NOT NULL,
+        batch_number INTEGER NOT NULL,
+        table_name TEXT NOT NULL,
+        rows INTEGER,
+        committed_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        PRIMARY KEY (ingest_id, batch_number)
+    )""",
+]
+# a concurrent claim of the same batch waits until the first transaction is done
+CLAIM_BATCH_SQL = """INSERT INTO ingest.batch_ledger (ingest_id, batch_number, table_name) VALUES ($1, $2, $3)
+                     ON CONFLICT DO NOTHING RETURNING true"""
+COMMITTED_ROWS_SQL = "SELECT rows FROM ingest.batch_ledger WHERE ingest_id = $1 AND batch_number = $2"
+RECORD_BATCH_SQL = "UPDATE ingest.batch_ledger SET rows = $3, committed_at = now() WHERE ingest_id = $1 AND batch_number = $2"
 
 app = df.DFApp(http_auth_level=func.AuthLevel.ANONYMOUS)
 
@@ -52,6 +89,42 @@ BLOB_SERVICE_CLIENT = BlobServiceClient(STORAGE_ACCOUNT_URL, credential=DEFAULT_
 # this is only used at the beginning, we use async later in the event loop
 DB_ENGINE = create_engine(DATABASE_ENDPOINT)
 
+# the activities share one asyncpg pool per worker, created on first use
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", 1))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", 10))
+DB_POOL = None
+DB_POOL_LOCK = asyncio.Lock()
+DB_POOL_METRICS = LatencyMetrics()
+
+
+async def _get_db_pool():
+    global DB_POOL
+    if DB_POOL is None:
+        async with DB_POOL_LOCK:
+            if DB_POOL is None:
+                logging.info(f"Creating database pool with {DB_POOL_MIN_SIZE}-{DB_POOL_MAX_SIZE} connections")
+                DB_POOL = await asyncpg.create_pool(DATABASE_ENDPOINT, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE)
+    return DB_POOL
+
+
+# borrow a connection from the pool and record how long we had to wait for it
+@asynccontextmanager
+async def _acquire_connection():
+    pool = await _get_db_pool()
+    wait_start = time.perf_counter()
+    async with pool.acquire() as conn:
+        DB_POOL_METRICS.record(time.perf_counter() - wait_start)
+        yield conn
+
+
+def _pool_metrics():
+    metrics = DB_POOL_METRICS.snapshot()
+    if DB_POOL is not None:
+        metrics["size"] = DB_POOL.get_size()
+        metrics["idle"] = DB_POOL.get_idle_size()
+        metrics["max_size"] = DB_POOL.get_max_size()
+    return metrics
+
 # TODO: 
 # - figure out if we need to identify a primary key
 @app.service_bus_queue_trigger(arg_name="message", 
@@ -65,25 +138,106 @@ async def durable_client_trigger(message: func.ServiceBusMessage, client: df.Dur
     # create the table schema
     table_name = event_json['table_name']
     table_description = event_json['file_description']
+    table_header = event_json['header']
+    _create_ledger()
     if not _table_exists(table_name):
-        table_header = event_json['header']
+        column_types = _sample_column_types(event_json, table_header)
         metadata_obj = MetaData()
-        table = _create_table_schema(table_name, table_header, table_description, metadata_obj)
-        # create the new table with the simple schema (TODO: add ability to provide better schema)
+        table = _create_table_schema(table_name, table_header, table_description, metadata_obj, column_types)
+        # create the new table with the inferred column types
         metadata_obj.create_all(DB_ENGINE)
         logging.info(f"Table created: {table}")
     else:
         logging.info(f"Table already exists: {table_name}")
+    # the activities convert the csv values based on what is actually in the database
+    event_json['column_types'] = _get_column_types(table_name, table_header)
     DB_ENGINE.dispose()
     SOMETHING = await client.start_new("process_statsbatch", client_input=event_json)
 
 
+def _create_ledger():
+    with DB_ENGINE.begin() as conn:
+        for statement in LEDGER_SCHEMA_SQL:
+            conn.execute(text(statement))
+
+
+# batches of this version of the file that are already in the database, with their row counts
+def _get_committed_batches(ingest_id):
+    with DB_ENGINE.connect() as conn:
+        result = conn.execute(text("SELECT batch_number, rows FROM ingest.batch_ledger WHERE ingest_id = :ingest_id AND rows IS NOT NULL"),
+                              {"ingest_id": ingest_id})
+        return {row.batch_number: row.rows for row in result}
+
+
 def _table_exists(table_name):
     inspector = reflection.Inspector.from_engine(DB_ENGINE)
     return inspector.has_table(table_name)
 
 
-def _create_table_schema(table_name, table_header, table_description, metadata_obj):
+# sqlalchemy types for the column types from infer_column_types
+COLUMN_TYPES = {
+    "bigint": BigInteger,
+    "double": DOUBLE_PRECISION,
+    "numeric": Numeric,
+    "date": Date,
+    "text": Text,
+}
+
+
+# older messages don't say what format the file is in, look at the first bytes then
+def _get_file_format(blob_client, eventjson):
+    if eventjson.get('file_format'):
+        return eventjson['file_format']
+    head = blob_client.download_blob(offset=0, length=4).readall()
+    return detect_format(eventjson['file_name'], head)
+
+
+def _open_parquet_blob(blob_client, blob_size):
+    return open_parquet(RangeReader(lambda offset, length: _read_blob_range(blob_client, offset, length), blob_size))
+
+
+# infer the column types from the first part of the file (or the schema for parquet)
+def _sample_column_types(event_json, table_header):
+    file_name = event_json['file_name']
+    blob_client = _get_blob_client(file_name)
+    blob_size = blob_client.get_blob_properties().size
+    file_format = _get_file_format(blob_client, event_json)
+    sample_end = min(TYPE_SAMPLE_BYTES, blob_size)
+    if file_format == "parquet":
+        column_types = parquet_column_types(_open_parquet_blob(blob_client, blob_size), table_header)
+    elif file_format != "csv":
+        # the sample is cut off in the middle of the compressed stream, so only use complete lines
+        chunks = iter_decompressed(_read_blob_range(blob_client, 0, sample_end), file_format)
+        lines = skip_header(iter_lines(chunks, complete_only=sample_end < blob_size))
+        column_types = infer_column_types(table_header, iter_csv_rows(lines))
+    else:
+        data_start, _ = estimate_row_bytes(blob_client.download_blob(offset=0, length=min(SAMPLE_BYTES, blob_size)).readall() if blob_size else b"")
+        lines = iter_range_lines(lambda offset, length: _read_blob_range(blob_client, offset, length), data_start, sample_end, blob_size)
+        column_types = infer_column_types(table_header, iter_csv_rows(lines))
+    logging.info(f"Inferred column types for {file_name} ({file_format}): {dict(zip(table_header, column_types))}")
+    return column_types
+
+
+# map the columns of an existing table back to our column types, in header order
+def _get_column_types(table_name, table_header):
+    inspector = reflection.Inspector.from_engine(DB_ENGINE)
+    db_types = {}
+    for column in inspector.get_columns(table_name):
+        column_type = column['type']
+        if isinstance(column_type, Integer):
+            db_types[column['name']] = "bigint"
+        elif isinstance(column_type, Float):
+            db_types[column['name']] = "double"
+        elif isinstance(column_type, Numeric):
+            db_types[column['name']] = "numeric"
+        elif isinstance(column_type, Date):
+            db_types[column['name']] = "date"
+        else:
+            db_types[column['name']] = "text"
+    return [db_types.get(field, "text") for field in table_header]
+
+
+def _create_table_schema(table_name, table_header, table_description, metadata_obj, column_types):
     # Take LLM inference of table schema out for now
     """
     prompt = f"Create a table schema for a CSV with the following header row: {table_header}." \
@@ -99,60 +253,257 @@ def _create_table_schema(table_name, table_header, table_description, metadata_o
     response = infer_table_schema_using_llm(payload, "{}")
     logging.info(f"Response: {response}")
     """
-    columns = [Column(field, VARCHAR, primary_key=(field == "playerID")) for field in table_header]
+    columns = [Column(field, COLUMN_TYPES[column_type], primary_key=(field == "playerID"))
+               for field, column_type in zip(table_header, column_types)]
     table = Table(table_name, metadata_obj, *columns, comment=table_description)
     return table
 
-def _get_csv_file(file_name):
-    data_df = None
-    try:
-        logging.info(f"Downloading file name: {file_name} from container {STORAGE_CONTAINER_CSV}")
-        container_client = BLOB_SERVICE_CLIENT.get_container_client(STORAGE_CONTAINER_CSV)
-        blob_client = container_client.get_blob_client(file_name)
-        blob_data = blob_client.download_blob().readall()
-        data_df = pd.read_csv(BytesIO(blob_data))    
-    except Exception as e:
-        logging.error(f"Error getting CSV file: {e}")
-    return data_df
+def _get_blob_client(file_name):
+    container_client = BLOB_SERVICE_CLIENT.get_container_client(STORAGE_CONTAINER_CSV)
+    return container_client.get_blob_client(file_name)
+
+
+# ranged read of a part of the blob, returns an iterator over the downloaded chunks
+def _read_blob_range(blob_client, offset, length):
+    return blob_client.download_blob(offset=offset, length=length).chunks()
+
+
+# the orchestrator only plans byte ranges, the activities fetch and parse their own slice
+# this keeps the orchestrator history (and memory) flat no matter how big the file is
+@app.activity_trigger(input_name="eventjson")
+def plan_statsbatches(eventjson: dict):
+    file_name = eventjson['file_name']
+    logging.info(f"Planning batches for file name: {file_name} from container {STORAGE_CONTAINER_CSV}")
+    blob_client = _get_blob_client(file_name)
+    properties = blob_client.get_blob_properties()
+    blob_size = properties.size
+    file_format = _get_file_format(blob_client, eventjson)
+    if file_format == "parquet":
+        # every row group is a batch of its own
+        parquet_file = _open_parquet_blob(blob_client, blob_size)
+        batches = [{"batchnumber": i, "row_group": i} for i in range(parquet_file.num_row_groups)]
+        logging.info(f"File {file_name} has {parquet_file.metadata.num_rows} rows in {len(batches)} row groups")
+    elif file_format != "csv":
+        # a compressed stream can't be split into byte ranges, one activity streams the whole file
+        batches = [{"batchnumber": 0}]
+        logging.info(f"File {file_name} is {file_format} compressed ({blob_size} bytes) and will be processed in a single batch")
+    else:
+        sample = blob_client.download_blob(offset=0, length=min(SAMPLE_BYTES, blob_size)).readall() if blob_size else b""
+        data_start, avg_row_bytes = estimate_row_bytes(sample)
+        batches = plan_byte_ranges(blob_size, data_start, avg_row_bytes, BATCH_SIZE)
+        logging.info(f"File {file_name} has {blob_size} bytes (~{avg_row_bytes} bytes/row) and will be processed in {len(batches)} batches")
+
+    # the plan only depends on the blob content and BATCH_SIZE, so the same version of a file
+    # always gets the same batches and we can resume from the ones already committed
+    ingest_id = f"{eventjson['table_name']}:{file_name}:{properties.etag}:{BATCH_SIZE}"
+    committed = _get_committed_batches(ingest_id)
+    if committed:
+        logging.info(f"Resuming {ingest_id}: {len(committed)} of {len(batches)} batches ({sum(committed.values())} rows) already committed")
+    return {
+        "blob_size": blob_size,
+        "file_format": file_format,
+        "ingest_id": ingest_id,
+        "batches": [batch for batch in batches if batch['batchnumber'] not in committed],
+        "committed_rows": sum(committed.values()),
+    }
+
 
 @app.orchestration_trigger(context_name="context")
 def process_statsbatch(context: df.DurableOrchestrationContext):
     event_json = context.get_input()
     logging.info(f"Received event: {event_json}")
-    data_df = _get_csv_file(event_json['file_name'])
-    num_batches = int(np.ceil(len(data_df) / BATCH_SIZE))
-    logging.info(f"Data has {len(data_df)} rows and will be processed in {num_batches} batches")
-    parallel_tasks = []
-    for i in range(num_batches):
-        logging.info(f"Kicking off batch: {i}")
-        batch = data_df[i*BATCH_SIZE:(i+1)*BATCH_SIZE]
-        #batchrows = [list(record.values()) for record in batch.to_dict(orient="records")]
-        batchrows = batch.to_dict(orient="records")
-        logging.info(f"Batch {i} has {len(batchrows)} rows and starts with {batchrows[0]}")
-        event_json['batchnumber'] = i
-        event_json['batchrows'] = batchrows
-        parallel_tasks.append(context.call_activity("insert_statsbatch", event_json))
-    parallel_outputs = yield context.task_all(parallel_tasks)
-
-# event_json is not eventjson and has batchnumber and batchrows now
+    plan = yield context.call_activity("plan_statsbatches", event_json)
+    max_concurrency = 1 if event_json['table_name'] in INGEST_ORDERED_TABLES else INGEST_CONCURRENCY
+    limiter = AdaptiveConcurrency(max_concurrency, INGEST_BACKPRESSURE_FACTOR)
+    retry_options = df.RetryOptions(first_retry_interval_in_milliseconds=INGEST_RETRY_INTERVAL_MS,
+                                    max_number_of_attempts=INGEST_MAX_ATTEMPTS)
+
+    # keep up to limiter.concurrency batches in flight and start the next one as soon as one finishes
+    pending = list(reversed(plan['batches']))
+    running = []
+    num_rows = plan['committed_rows']
+    while pending or running:
+        while pending and len(running) < limiter.concurrency:
+            batch = pending.pop()
+            logging.info(f"Kicking off batch: {batch['batchnumber']} ({len(running) + 1}/{limiter.concurrency} running)")
+            batch_input = {**event_json, **batch, "blob_size": plan['blob_size'], "file_format": plan['file_format'],
+                           "ingest_id": plan['ingest_id']}
+            running.append(context.call_activity_with_retry("insert_statsbatch", retry_options, batch_input))
+        finished = yield context.task_any(running)
+        running.remove(finished)
+        # a batch that failed all INGEST_MAX_ATTEMPTS finishes too, with the exception as its result
+        if isinstance(finished.result, Exception):
+            raise finished.result
+        num_rows += finished.result['rows']
+        limiter.record(finished.result)
+    return num_rows
+
+# eventjson is the orchestrator input plus batchnumber, blob_size, file_format, ingest_id and
+# start/end (byte range of a csv) or row_group (parquet), compressed csv is a single batch
+# the COPY and the ledger entry commit together, so a retried batch is either skipped or redone from scratch
 @app.activity_trigger(input_name="eventjson")
 async def insert_statsbatch(eventjson: dict):
     logging.info(f"Inserting statsbatch: {eventjson['batchnumber']}")
-    batchrows = eventjson['batchrows']
     table_name = eventjson['table_name']
-    conn = await asyncpg.connect(DATABASE_ENDPOINT)
+    record_batches, description = _get_record_batches(eventjson)
+
+    ingest_id, batchnumber = eventjson['ingest_id'], eventjson['batchnumber']
     try:
-        # TODO: maybe switch to asyncpg.copy_records_to_table
-        num_batches = int(np.ceil(len(batchrows) / SUB_BATCH_SIZE))
-        logging.info(f"Inserting {len(batchrows)} rows into {table_name} in {num_batches} sub-batches")
+        async with _acquire_connection() as conn:
+            async with conn.transaction():
+                claimed = await conn.fetchval(CLAIM_BATCH_SQL, ingest_id, batchnumber, table_name)
+                if not claimed:
+                    rows = await conn.fetchval(COMMITTED_ROWS_SQL, ingest_id, batchnumber)
+                    logging.info(f"Statsbatch {batchnumber} of {ingest_id} was already committed with {rows} rows, skipping")
+                    return {"rows": rows or 0, "skipped": True, "sub_batches": 0, "copy_seconds": 0.0,
+                            "seconds": 0.0, "rows_per_second": 0.0}
+                logging.info(f"Inserting {description} into {table_name} in sub-batches of up to {SUB_BATCH_SIZE} rows / {SUB_BATCH_BYTES} bytes")
+                stats = await copy_record_batches(conn, table_name, eventjson['header'], record_batches)
+                await conn.execute(RECORD_BATCH_SQL, ingest_id, batchnumber, stats['rows'])
+    except Exception as e:
+        # let the durable framework retry the batch, nothing of it has been committed
+        logging.error(f"Error inserting statsbatch {batchnumber} of {ingest_id}: {e}")
+        raise
+    stats["pool"] = _pool_metrics()
+    logging.info(f"Inserted {stats['rows']} rows of statsbatch {eventjson['batchnumber']} into {table_name} "
+                 f"in {stats['sub_batches']} sub-batches at {stats['rows_per_second']:.0f} rows/sec")
+    logging.info(f"Database pool: {stats['pool']}")
+    return stats
+
+
+
+# where the records of a batch come from, depending on the file format
+def _get_record_batches(eventjson):
+    blob_client = _get_blob_client(eventjson['file_name'])
+    blob_size = eventjson['blob_size']
+    file_format = eventjson.get('file_format', "csv")
+    header, column_types = eventjson['header'], eventjson['column_types']
+    if file_format == "parquet":
+        # column projection on the header, pyarrow only fetches the column chunks it needs
+        parquet_file = _open_parquet_blob(blob_client, blob_size)
+        row_group = eventjson['row_group']
+        return (iter_parquet_record_batches(parquet_file, row_group, header, column_types, SUB_BATCH_SIZE),
+                f"row group {row_group}")
+    if file_format != "csv":
+        chunks = iter_decompressed(blob_client.download_blob().chunks(), file_format)
+        lines = skip_header(iter_lines(chunks))
+        description = f"{file_format} compressed file"
+    else:
+        start, end = eventjson['start'], eventjson['end']
+        lines = iter_range_lines(lambda offset, length: _read_blob_range(blob_client, offset, length), start, end, blob_size)
+        description = f"bytes {start}-{end}"
+    return iter_csv_record_batches(lines, column_types, SUB_BATCH_SIZE, SUB_BATCH_BYTES), description
 
-        for i in range(num_batches):
-            logging.info(f"Inserting sub-batch {i}")
-            batch = [[str(value) for value in row.values()] for row in batchrows[i*BATCH_SIZE:(i+1)*BATCH_SIZE]]
+
+# table to use for plain csv lines whose header doesn't match any existing table
+SINGLE_LINE_DEFAULT_TABLE = os.getenv("SINGLE_LINE_DEFAULT_TABLE", None)
+# upper bound of rows per COPY when a message batch is flushed
+SINGLE_LINE_FLUSH_ROWS = int(os.getenv("SINGLE_LINE_FLUSH_ROWS", 5000))
+# time from enqueueing a row to it being committed
+SINGLE_LINE_LAG_METRICS = LatencyMetrics()
+# column names and types of the tables we've written to, per worker
+TABLE_COLUMNS = {}
+
+
+async def _load_table_columns(conn):
+    rows = await conn.fetch("""SELECT table_name, array_agg(column_name::text ORDER BY ordinal_position) AS columns,
+                                      array_agg(data_type::text ORDER BY ordinal_position) AS data_types
+                               FROM information_schema.columns WHERE table_schema = 'public' GROUP BY table_name""")
+    TABLE_COLUMNS.clear()
+    for row in rows:
+        TABLE_COLUMNS[row['table_name']] = dict(zip(row['columns'], [column_type_from_pg(t) for t in row['data_types']]))
+
+
+# plain csv messages don't name their table, pick the one with exactly this header
+async def _resolve_table_name(conn, header):
+    for refresh in (False, True):
+        if refresh or not TABLE_COLUMNS:
+            await _load_table_columns(conn)
+        for table_name, columns in TABLE_COLUMNS.items():
+            if list(columns) == header:
+                return table_name
+    return SINGLE_LINE_DEFAULT_TABLE
+
+
+async def _ensure_table(conn, table_name, description, header, rows):
+    if table_name not in TABLE_COLUMNS:
+        await _load_table_columns(conn)
+    if table_name not in TABLE_COLUMNS:
+        column_types = infer_column_types(header, rows)
+        columns = ", ".join(f'"{name}" {PG_TYPES[column_type]}' for name, column_type in zip(header, column_types))
+        await conn.execute(f'CREATE TABLE IF NOT EXISTS "{table_name}" ({columns})')
+        if description:
+            await conn.execute(f"COMMENT ON TABLE \"{table_name}\" IS {_quote_literal(description)}")
+        logging.info(f"Table created: {table_name} {dict(zip(header, column_types))}")
+        await _load_table_columns(conn)
+    return [TABLE_COLUMNS[table_name].get(name, "text") for name in header]
+
+
+def _quote_literal(value):
+    return "'" + value.replace("'", "''") + "'"
+
+
+# consumes the rows pushed by upload_data_single
+# the host hands us the messages in batches (see serviceBus in host.json, maxMessageBatchSize is the
+# row count threshold and maxBatchWaitTime the latency threshold) and we flush every batch with one
+# COPY per table, each in its own transaction: a table whose header doesn't fit is logged and
+# skipped rather than sending the rows of every other table back to the queue
+@app.service_bus_queue_trigger(arg_name="messages",
+                               queue_name="%SINGLE_LINE_SERVICEBUS_QUEUE_NAME%",
+                               connection="SERVICEBUS_CONNECTION",
+                               cardinality=func.Cardinality.MANY)
+async def ingest_single_lines(messages: typing.List[func.ServiceBusMessage]):
+    logging.info(f"Received {len(messages)} single line messages")
+    parsed = []
+    for message in messages:
+        try:
+            parsed.append((message, parse_single_line_message(message.get_body().decode("utf-8"))))
+        except Exception as e:
+            # a malformed message would otherwise poison the whole batch
+            logging.error(f"Skipping malformed message {message.message_id}: {e}")
+
+    async with _acquire_connection() as conn:
+        groups = {}
+        for message, (table_name, description, header, rows) in parsed:
+            if not rows:
+                continue
+            table_name = table_name or await _resolve_table_name(conn, header)
+            if not table_name:
+                logging.error(f"No table matches the header of message {message.message_id}, skipping it")
+                continue
+            group = groups.setdefault((table_name, tuple(header)), {"description": description, "rows": [], "enqueued": []})
+            group["rows"].extend(rows)
+            group["enqueued"].append(message.enqueued_time_utc)
+
+        flushed = []
+        for (table_name, header), group in groups.items():
+            header = list(header)
             try:
-                await conn.copy_records_to_table(table_name, records=batch)
-            except Exception as e:
-                logging.error(f"Error inserting batch: {e}")
-    finally:
-        await conn.close()
-    return True
\ No newline at end of file
+                async with conn.transaction():
+                    column_types = await _ensure_table(conn, table_name, group["description"], header, group["rows"])
+                    records = []
+                    for row in group["rows"]:
+                        try:
+                            records.extend(convert_rows([row], column_types))
+                        except ValueError as e:
+                            # don't let a single bad row send the whole batch back to the queue
+                            logging.error(f"Skipping row for {table_name} that doesn't match the column types: {row} ({e})")
+                    for i in range(0, len(records), SINGLE_LINE_FLUSH_ROWS):
+                        await conn.copy_records_to_table(table_name, records=records[i:i + SINGLE_LINE_FLUSH_ROWS], columns=header)
+            except asyncpg.PostgresConnectionError:
+                # nothing of this batch can be written, let Service Bus redeliver it
+                raise
+            except (asyncpg.PostgresError, ValueError) as e:
+                logging.error(f"Skipping {len(group['rows'])} rows from {len(group['enqueued'])} messages for {table_name} "
+                              f"with header {header}: {e}")
+                continue
+            flushed.append(group)
+            logging.info(f"Flushed {len(group['rows'])} rows from {len(group['enqueued'])} messages into {table_name}")
+
+    committed = datetime.now(timezone.utc)
+    for group in flushed:
+        for enqueued in group["enqueued"]:
+            if enqueued:
+                enqueued = enqueued if enqueued.tzinfo else enqueued.replace(tzinfo=timezone.utc)
+                SINGLE_LINE_LAG_METRICS.record((committed - enqueued).total_seconds())
+    logging.info(f"Single line ingest lag: {SINGLE_LINE_LAG_METRICS.snapshot()}")
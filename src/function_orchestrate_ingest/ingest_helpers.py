@@ -0,0 +1,501 @@
+import asyncio
+import csv
+import io
+import json
+import os
+import re
+import time
+import zlib
+from collections import deque
+from datetime import date
+from decimal import Decimal
+
+# helpers for the ingest function app that don't depend on the azure sdk,
+# kept separate so they can be exercised locally without the functions host
+
+# how many bytes we peek at to estimate the average row size of a file
+SAMPLE_BYTES = 64 * 1024
+# how much of the file we look at to infer the column types of a new table
+TYPE_SAMPLE_BYTES = 1024 * 1024
+# how far past the end of a range we read at a time to finish a straddling row
+LINE_OVERREAD_BYTES = 16 * 1024
+
+
+# returns the offset of the first data row (right after the header line)
+# and the average size of a data row based on the sample
+def estimate_row_bytes(sample: bytes):
+    header_end = sample.find(b"\n")
+    if header_end < 0:
+        # header only (or a single row without a line break)
+        return len(sample), len(sample) or 1
+    data_start = header_end + 1
+    data = sample[data_start:]
+    num_rows = data.count(b"\n")
+    if num_rows == 0:
+        return data_start, len(data) or 1
+    # the last line of the sample is likely cut off so only count complete rows
+    complete = data[:data.rfind(b"\n") + 1]
+    return data_start, max(1, len(complete) // num_rows)
+
+
+# split [data_start, blob_size) into byte ranges of roughly batch_size rows each
+# the ranges don't need to line up with row boundaries, see iter_range_lines
+def plan_byte_ranges(blob_size, data_start, avg_row_bytes, batch_size):
+    chunk_bytes = max(avg_row_bytes * batch_size, LINE_OVERREAD_BYTES)
+    ranges = []
+    start = data_start
+    while start < blob_size:
+        end = min(start + chunk_bytes, blob_size)
+        ranges.append({"batchnumber": len(ranges), "start": start, "end": end})
+        start = end
+    return ranges
+
+
+def iter_range_lines(read_range, start, end, blob_size, overread=LINE_OVERREAD_BYTES):
+    """
+    Yield the lines whose first byte falls into [start, end), without line breaks.
+
+    read_range(offset, length) has to return an iterable of byte chunks for that
+    part of the blob. We read one byte before start to know whether start is the
+    beginning of a line, and keep reading past end in small steps until the line
+    straddling end is complete. Every line therefore belongs to exactly one range.
+    Quoted fields with embedded line breaks are not supported.
+    """
+    offset = max(start - 1, 0)
+    read_pos = offset
+    read_end = min(end, blob_size)
+    line_start = offset
+    buffer = b""
+    while True:
+        if read_pos < read_end:
+            chunks = read_range(read_pos, read_end - read_pos)
+        elif buffer and read_pos < blob_size:
+            length = min(overread, blob_size - read_pos)
+            read_end = read_pos + length
+            chunks = read_range(read_pos, length)
+        else:
+            break
+        for chunk in chunks:
+            read_pos += len(chunk)
+            *lines, buffer = (buffer + chunk).split(b"\n")
+            for line in lines:
+                current = line_start
+                line_start += len(line) + 1
+                if current >= end:
+                    return
+                if current >= start:
+                    yield line.rstrip(b"\r")
+    if buffer and start <= line_start < end:
+        yield buffer.rstrip(b"\r")
+
+
+# parse raw csv lines into rows, one line at a time
+def iter_csv_rows(lines, encoding="utf-8"):
+    return csv.reader(line.decode(encoding) for line in lines if line)
+
+
+INT_PATTERN = re.compile(r"^[+-]?\d+$")
+FLOAT_PATTERN = re.compile(r"^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$")
+DATE_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+# bigint only holds signed 64 bit values, anything longer (ids with leading zeros etc.) stays text
+INT_MAX_DIGITS = 18
+
+# postgres names of the column types, for when we create tables without sqlalchemy
+PG_TYPES = {
+    "bigint": "bigint",
+    "double": "double precision",
+    "numeric": "numeric",
+    "date": "date",
+    "text": "text",
+}
+
+# map a postgres data_type (information_schema.columns) back to one of our column types
+def column_type_from_pg(data_type):
+    if data_type in ("bigint", "integer", "smallint"):
+        return "bigint"
+    if data_type in ("double precision", "real"):
+        return "double"
+    if data_type in ("numeric", "date"):
+        return data_type
+    return "text"
+
+
+# the column types we infer and how a csv value gets converted for the binary COPY
+CONVERTERS = {
+    "bigint": int,
+    "double": float,
+    "numeric": Decimal,
+    "date": date.fromisoformat,
+    "text": str,
+}
+
+
+def _infer_value_type(value):
+    if INT_PATTERN.match(value) and len(value.lstrip("+-")) <= INT_MAX_DIGITS:
+        return "bigint"
+    if FLOAT_PATTERN.match(value):
+        return "double"
+    if DATE_PATTERN.match(value):
+        try:
+            date.fromisoformat(value)
+            return "date"
+        except ValueError:
+            return "text"
+    return "text"
+
+
+# widen a column type so it can hold both types
+def _widen(current, new):
+    if current is None or current == new:
+        return new
+    if {current, new} == {"bigint", "double"}:
+        return "double"
+    return "text"
+
+
+# infer a column type (bigint, double, date, text) per header field from sample rows
+# empty values are NULLs and don't count, columns without any value default to text
+def infer_column_types(header, rows):
+    types = [None] * len(header)
+    for row in rows:
+        for i, value in enumerate(row[:len(header)]):
+            if value == "" or types[i] == "text":
+                continue
+            types[i] = _widen(types[i], _infer_value_type(value))
+    return [t or "text" for t in types]
+
+
+# turn parsed csv rows into typed records for the binary COPY, empty values become NULL
+def convert_rows(rows, column_types):
+    converters = [CONVERTERS[t] for t in column_types]
+    num_columns = len(converters)
+    records = []
+    for row in rows:
+        if len(row) < num_columns:
+            row = row + [""] * (num_columns - len(row))
+        records.append(tuple(None if value == "" else convert(value) for convert, value in zip(converters, row)))
+    return records
+
+
+# group raw lines into sub-batches capped by row count and by raw size,
+# so wide tables get fewer rows per COPY and narrow tables more
+def iter_sub_batches(lines, max_rows, max_bytes):
+    batch = []
+    batch_bytes = 0
+    for line in lines:
+        if not line:
+            continue
+        batch.append(line)
+        batch_bytes += len(line) + 1
+        if len(batch) >= max_rows or batch_bytes >= max_bytes:
+            yield batch, batch_bytes
+            batch = []
+            batch_bytes = 0
+    if batch:
+        yield batch, batch_bytes
+
+
+# parse and convert csv lines into record batches for copy_record_batches
+def iter_csv_record_batches(lines, column_types, max_rows, max_bytes):
+    for batch_lines, batch_bytes in iter_sub_batches(lines, max_rows, max_bytes):
+        yield convert_rows(list(iter_csv_rows(batch_lines)), column_types), batch_bytes
+
+
+async def copy_record_batches(conn, table_name, columns, record_batches):
+    """
+    COPY the (records, size) batches into table_name and return throughput stats.
+
+    Producing the next batch (reading, parsing and converting it) runs on a worker
+    thread while the current COPY is in flight, so the connection is never idle
+    waiting for python to build records (the source may do blocking blob reads).
+    """
+    loop = asyncio.get_running_loop()
+
+    def prepare():
+        return next(record_batches, None)
+
+    stats = {"rows": 0, "bytes": 0, "sub_batches": 0, "copy_seconds": 0.0}
+    start = time.perf_counter()
+    pending = loop.run_in_executor(None, prepare)
+    try:
+        while True:
+            prepared = await pending
+            if prepared is None:
+                break
+            records, batch_bytes = prepared
+            pending = loop.run_in_executor(None, prepare)
+            copy_start = time.perf_counter()
+            await conn.copy_records_to_table(table_name, records=records, columns=columns)
+            stats["copy_seconds"] += time.perf_counter() - copy_start
+            stats["rows"] += len(records)
+            stats["bytes"] += batch_bytes
+            stats["sub_batches"] += 1
+    finally:
+        # don't leave the next conversion running if a COPY failed
+        if not pending.done():
+            await asyncio.wait([pending])
+    stats["seconds"] = time.perf_counter() - start
+    stats["rows_per_second"] = stats["rows"] / stats["seconds"] if stats["seconds"] else 0.0
+    return stats
+
+
+# COPY csv lines in sub-batches of at most max_rows rows and roughly max_bytes
+async def copy_in_sub_batches(conn, table_name, columns, column_types, lines, max_rows, max_bytes):
+    record_batches = iter_csv_record_batches(lines, column_types, max_rows, max_bytes)
+    return await copy_record_batches(conn, table_name, columns, record_batches)
+
+
+# keeps track of latencies (pool waits, ingest lag) over a sliding window of recent samples
+class LatencyMetrics:
+    def __init__(self, window=1000):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = deque(maxlen=window)
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.recent.append(seconds)
+
+    def percentile(self, p):
+        recent = sorted(self.recent)
+        if not recent:
+            return 0.0
+        return recent[min(len(recent) - 1, int(len(recent) * p))]
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "avg_seconds": self.total / self.count if self.count else 0.0,
+            "p50_seconds": self.percentile(0.50),
+            "p95_seconds": self.percentile(0.95),
+            "p99_seconds": self.percentile(0.99),
+            "max_seconds": self.max,
+        }
+
+
+class AdaptiveConcurrency:
+    """
+    AIMD limit on how many batches of a file are ingested in parallel.
+
+    Every finished batch reports its average COPY latency. The lowest latency seen
+    is the baseline, a batch slower than backpressure_factor times the baseline
+    halves the limit (at most once per round of in-flight batches), every other
+    batch raises it by one up to max_concurrency. Only uses the batch results so
+    it replays deterministically inside an orchestrator.
+    """
+    def __init__(self, max_concurrency, backpressure_factor=2.0, min_concurrency=1):
+        self.max_concurrency = max(min_concurrency, max_concurrency)
+        self.min_concurrency = min_concurrency
+        self.backpressure_factor = backpressure_factor
+        self.concurrency = self.max_concurrency
+        self.baseline = None
+        self._since_decrease = 0
+
+    def record(self, stats):
+        self._since_decrease += 1
+        sub_batches = stats.get("sub_batches", 0)
+        if not sub_batches:
+            return self.concurrency
+        latency = stats["copy_seconds"] / sub_batches
+        if self.baseline is None or latency < self.baseline:
+            self.baseline = latency
+        if latency > self.baseline * self.backpressure_factor:
+            if self._since_decrease >= self.concurrency:
+                self.concurrency = max(self.min_concurrency, self.concurrency // 2)
+                self._since_decrease = 0
+        elif self.concurrency < self.max_concurrency:
+            self.concurrency += 1
+        return self.concurrency
+
+
+# compressed csv lands in the same table as the plain file would
+def table_name_for_file(file_name):
+    for extension in COMPRESSED_EXTENSIONS:
+        if file_name.lower().endswith(extension):
+            file_name = file_name[:-len(extension)]
+            break
+    return file_name.replace(".", "_").lower()
+
+
+def parse_single_line_message(body):
+    """
+    Parse a message of the single line queue into (table_name, description, header, rows).
+
+    Two formats end up on the queue: json from real-time-upload.py with file_name,
+    file_description, headers and either the row as a dict or a batch of them as
+    rows, and plain csv text (header line plus data lines) like the load test sends.
+    Plain csv doesn't name its table, table_name is None then and has to be
+    resolved from the header.
+    """
+    stripped = body.lstrip()
+    if stripped.startswith("{"):
+        event = json.loads(stripped)
+        headers = event["headers"]
+        header = [h.lower() for h in headers]
+        rows = [["" if row.get(h) is None else str(row.get(h)) for h in headers]
+                for row in event.get("rows", [event.get("row")]) if row]
+        # real-time-upload.py sends the path it was given, the batch path names tables after the blob
+        file_name = os.path.basename(event["file_name"].replace("\\", "/"))
+        return table_name_for_file(file_name), event.get("file_description"), header, rows
+    rows = list(csv.reader(line for line in stripped.splitlines() if line))
+    if not rows:
+        return None, None, [], []
+    return None, None, [h.lower() for h in rows[0]], rows[1:]
+
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+PARQUET_MAGIC = b"PAR1"
+COMPRESSED_EXTENSIONS = {".gz": "gzip", ".gzip": "gzip", ".zst": "zstd", ".zstd": "zstd"}
+
+
+# csv, gzip (compressed csv), zstd (compressed csv) or parquet, by magic bytes first and extension second
+def detect_format(file_name, head):
+    if head.startswith(GZIP_MAGIC):
+        return "gzip"
+    if head.startswith(ZSTD_MAGIC):
+        return "zstd"
+    if head.startswith(PARQUET_MAGIC):
+        return "parquet"
+    lower = file_name.lower()
+    if lower.endswith(".parquet"):
+        return "parquet"
+    for extension, file_format in COMPRESSED_EXTENSIONS.items():
+        if lower.endswith(extension):
+            return file_format
+    return "csv"
+
+
+def _decompressor(file_format):
+    if file_format == "gzip":
+        return zlib.decompressobj(wbits=31)
+    if file_format == "zstd":
+        # only needed for zstd files, keep it out of the import path otherwise
+        import zstandard
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError(f"Unsupported compression: {file_format}")
+
+
+# decompress a stream of chunks, concatenated gzip members / zstd frames included
+def iter_decompressed(chunks, file_format):
+    decompressor = _decompressor(file_format)
+    for chunk in chunks:
+        while chunk:
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+            chunk = b""
+            if decompressor.eof and decompressor.unused_data:
+                chunk = decompressor.unused_data
+                decompressor = _decompressor(file_format)
+
+
+# split a stream of chunks into lines, without line breaks
+# a trailing line without a line break is only returned if complete_only is False
+def iter_lines(chunks, complete_only=False):
+    buffer = b""
+    for chunk in chunks:
+        *lines, buffer = (buffer + chunk).split(b"\n")
+        for line in lines:
+            yield line.rstrip(b"\r")
+    if buffer and not complete_only:
+        yield buffer.rstrip(b"\r")
+
+
+def skip_header(lines):
+    next(lines, None)
+    return lines
+
+
+class RangeReader(io.RawIOBase):
+    """
+    Seekable, read-only file object over ranged reads of a blob.
+
+    read_range(offset, length) returns the chunks of that part of the blob, so a
+    reader like pyarrow only downloads the parts of the file it actually looks at
+    (for parquet the footer and the column chunks of the projected columns).
+    """
+    def __init__(self, read_range, size):
+        self._read_range = read_range
+        self._size = size
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._size
+        self._pos = max(0, offset)
+        return self._pos
+
+    def readinto(self, buffer):
+        length = min(len(buffer), self._size - self._pos)
+        if length <= 0:
+            return 0
+        data = b"".join(self._read_range(self._pos, length))
+        buffer[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+
+def open_parquet(file_object):
+    # pyarrow is only needed for parquet files, keep it out of the import path otherwise
+    import pyarrow.parquet as pq
+    return pq.ParquetFile(file_object)
+
+
+def column_type_from_arrow(arrow_type):
+    import pyarrow.types as pa_types
+    if pa_types.is_integer(arrow_type):
+        return "bigint"
+    if pa_types.is_floating(arrow_type):
+        return "double"
+    if pa_types.is_decimal(arrow_type):
+        return "numeric"
+    if pa_types.is_date(arrow_type):
+        return "date"
+    return "text"
+
+
+# parquet column types for the (lowercased) header, in header order
+def parquet_column_types(parquet_file, header):
+    fields = {field.name.lower(): field.type for field in parquet_file.schema_arrow}
+    return [column_type_from_arrow(fields[name]) if name in fields else "text" for name in header]
+
+
+# coerce python values (from parquet) to the column types of the target table
+def coerce_records(rows, column_types):
+    def coerce(value, column_type):
+        if value is None:
+            return None
+        if column_type == "text":
+            return value if isinstance(value, str) else str(value)
+        if column_type == "date" and isinstance(value, date):
+            return value
+        if column_type == "numeric":
+            return value if isinstance(value, Decimal) else Decimal(str(value))
+        if isinstance(value, str):
+            return CONVERTERS[column_type](value)
+        return int(value) if column_type == "bigint" else float(value) if column_type == "double" else value
+    return [tuple(coerce(value, column_type) for value, column_type in zip(row, column_types)) for row in rows]
+
+
+# read one row group with only the columns of the header, in batches of at most max_rows rows
+def iter_parquet_record_batches(parquet_file, row_group, header, column_types, max_rows):
+    names = {name.lower(): name for name in parquet_file.schema_arrow.names}
+    projected = [names[name] for name in header]
+    for batch in parquet_file.iter_batches(batch_size=max_rows, row_groups=[row_group], columns=projected):
+        rows = zip(*(column.to_pylist() for column in batch.columns))
+        yield coerce_records(rows, column_types), batch.nbytes
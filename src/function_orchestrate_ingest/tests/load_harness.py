@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+# Load harness for the ingest scheduler.
+#
+# Ingests every csv of data/baseball_databank into a local Postgres the way the
+# function app does (one scheduler per file, all files at once, sharing one pool)
+# and reports the end-to-end time for each concurrency level. Start a throwaway
+# Postgres first, e.g.
+#
+#   docker run -d --rm --name ingest-bench -e POSTGRES_PASSWORD=postgres -p 5432:5432 postgres:16
+#   python tests/load_harness.py --concurrency 1,2,4,8,16
+
+import argparse
+import asyncio
+import glob
+import os
+import sys
+import time
+
+import asyncpg
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from ingest_helpers import PG_TYPES, plan_byte_ranges, iter_range_lines, copy_in_sub_batches, AdaptiveConcurrency
+from benchmark_ingest import DEFAULT_ENDPOINT, load_file, wait_for_database
+
+DATA_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "..", "data", "baseball_databank")
+
+
+async def create_table(pool, table_name, header, column_types):
+    columns = ", ".join(f'"{name}" {PG_TYPES[column_type]}' for name, column_type in zip(header, column_types))
+    async with pool.acquire() as conn:
+        await conn.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+        await conn.execute(f'CREATE TABLE "{table_name}" ({columns})')
+
+
+async def insert_batch(pool, table_name, data, header, column_types, batch, args):
+    lines = iter_range_lines(lambda offset, length: [data[offset:offset + length]], batch["start"], batch["end"], len(data))
+    async with pool.acquire() as conn:
+        return await copy_in_sub_batches(conn, table_name, header, column_types, lines,
+                                         args.sub_batch_size, args.sub_batch_bytes)
+
+
+# same scheduling as process_statsbatch: a sliding window sized by AdaptiveConcurrency
+async def ingest_file(pool, file_path, concurrency, args):
+    data, data_start, avg_row_bytes, header, column_types = load_file(file_path)
+    table_name = "load_" + os.path.basename(file_path).replace(".", "_").lower()
+    await create_table(pool, table_name, header, column_types)
+
+    limiter = AdaptiveConcurrency(concurrency, args.backpressure_factor)
+    pending = list(reversed(plan_byte_ranges(len(data), data_start, avg_row_bytes, args.batch_size)))
+    running = set()
+    rows = 0
+    min_concurrency = concurrency
+    while pending or running:
+        while pending and len(running) < limiter.concurrency:
+            batch = pending.pop()
+            running.add(asyncio.create_task(insert_batch(pool, table_name, data, header, column_types, batch, args)))
+        finished, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+        for task in finished:
+            stats = task.result()
+            rows += stats["rows"]
+            min_concurrency = min(min_concurrency, limiter.record(stats))
+    return table_name, rows, min_concurrency
+
+
+async def run_level(args, files, concurrency):
+    # one worker's worth of connections, like DB_POOL_MAX_SIZE in the function app
+    pool = await asyncpg.create_pool(args.database_endpoint, min_size=1, max_size=args.pool_size)
+    try:
+        start = time.perf_counter()
+        results = await asyncio.gather(*[ingest_file(pool, file_path, concurrency, args) for file_path in files])
+        seconds = time.perf_counter() - start
+        async with pool.acquire() as conn:
+            for table_name, _, _ in results:
+                await conn.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+    finally:
+        await pool.close()
+    rows = sum(result[1] for result in results)
+    throttled = sum(1 for result in results if result[2] < concurrency)
+    return rows, seconds, throttled
+
+
+async def main(args):
+    await wait_for_database(args.database_endpoint)
+    files = sorted(f for f in glob.glob(os.path.join(args.directory, "*.csv"))
+                   if not os.path.basename(f).startswith("test_"))
+    print(f"Ingesting {len(files)} files from {args.directory}")
+    print(f"{'concurrency':>11} {'rows':>9} {'seconds':>8} {'rows/sec':>10} {'throttled files':>16}")
+    for concurrency in args.concurrency:
+        rows, seconds, throttled = await run_level(args, files, concurrency)
+        print(f"{concurrency:>11} {rows:>9} {seconds:>8.2f} {rows / seconds:>10.0f} {throttled:>16}")
+
+
+def int_list(value):
+    return [int(v) for v in value.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end ingest time of the baseball databank at several concurrency levels.")
+    parser.add_argument("--directory", type=str, default=os.path.normpath(DATA_DIRECTORY))
+    parser.add_argument("--database-endpoint", type=str, default=os.getenv("DATABASE_ENDPOINT", DEFAULT_ENDPOINT))
+    parser.add_argument("--concurrency", type=int_list, default=[1, 2, 4, 8, 16], help="INGEST_CONCURRENCY values to try")
+    parser.add_argument("--batch-size", type=int, default=int(os.getenv("BATCH_SIZE", 1000)))
+    parser.add_argument("--sub-batch-size", type=int, default=int(os.getenv("SUB_BATCH_SIZE", 100)))
+    parser.add_argument("--sub-batch-bytes", type=int, default=int(os.getenv("SUB_BATCH_BYTES", 1024 * 1024)))
+    parser.add_argument("--backpressure-factor", type=float, default=2.0)
+    parser.add_argument("--pool-size", type=int, default=int(os.getenv("DB_POOL_MAX_SIZE", 10)))
+
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,22 @@
+# Rows pushed by real-time-upload.py land in the table the batch ingest creates for the same file
+#
+#   cd src/function_orchestrate_ingest && python -m pytest tests
+
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from ingest_helpers import parse_single_line_message
+
+
+@pytest.mark.parametrize("file_name", ["Salaries.csv", "../data/Salaries.csv", "C:\\data\\Salaries.csv"])
+def test_table_name_ignores_the_directory(file_name):
+    body = json.dumps({"file_name": file_name, "file_description": "salaries", "headers": ["yearID", "salary"],
+                       "rows": [{"yearID": 1998, "salary": 1000}]})
+    table_name, description, header, rows = parse_single_line_message(body)
+    assert table_name == "salaries_csv"
+    assert header == ["yearid", "salary"]
+    assert rows == [["1998", "1000"]]
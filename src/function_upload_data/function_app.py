@@ -1,8 +1,8 @@
 import os
 import json
 import logging
-import io
-import pandas as pd
+import csv
+import zlib
 from azure.identity.aio import DefaultAzureCredential, ManagedIdentityCredential
 from datetime import datetime, timedelta, timezone
 import azure.functions as func
@@ -12,7 +12,18 @@ app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
 STORAGE_CONTAINER_CSV = os.getenv("STORAGE_CONTAINER_CSV")
 default_credential = DefaultAzureCredential(managed_identity_client_id=os.getenv('AZURE_CLIENT_ID'))
 account_url = f"https://{os.getenv('AzureWebJobsStorage__accountName')}.blob.core.windows.net"
-blob_service_client = BlobServiceClient(account_url, credential=default_credential)
+# uploads are streamed into the blob as staged blocks of UPLOAD_CHUNK_SIZE, with up to
+# UPLOAD_MAX_CONCURRENCY blocks in flight, so memory is bounded by the chunk size
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", 4 * 1024 * 1024))
+UPLOAD_MAX_CONCURRENCY = int(os.getenv("UPLOAD_MAX_CONCURRENCY", 4))
+# the header has to be within this many bytes at the start of the file
+HEADER_SNIFF_BYTES = 64 * 1024
+# for compressed files we read up to this much to get the header decompressed
+COMPRESSED_HEADER_MAX_BYTES = 4 * 1024 * 1024
+# a service bus message (standard tier) can't be larger than 256KB, leave some room for the headers
+SINGLE_LINE_MAX_BODY_BYTES = int(os.getenv("SINGLE_LINE_MAX_BODY_BYTES", 240 * 1024))
+blob_service_client = BlobServiceClient(account_url, credential=default_credential,
+                                        max_block_size=UPLOAD_CHUNK_SIZE, max_single_put_size=UPLOAD_CHUNK_SIZE)
 container_client = blob_service_client.get_container_client(STORAGE_CONTAINER_CSV)
 
 # accept a file, store it in blob storage, and send a message to service bus about the file with extra metadata and context
@@ -33,17 +44,32 @@ async def upload_data(req: func.HttpRequest, message: func.Out[str]) -> func.Htt
         if not file_data or not file_name:
             return func.HttpResponse("Missing file_data or file_name in the request.\n", status_code=400)
 
-        # Read binary data from the file_data object
-        binary_filedata = file_data.read()
-        csv_data = io.BytesIO(binary_filedata)
-        csv_df = pd.read_csv(csv_data, nrows=2)
-        header = [h.lower() for h in csv_df.columns.tolist()]
+        # only look at the first chunk for the header and stream the file into blob storage
+        stream = file_data.stream
+        first_chunk = stream.read(HEADER_SNIFF_BYTES)
+        file_format = _detect_format(file_name, first_chunk)
+        if file_format == "parquet":
+            # the parquet schema is in the footer, so we need to be able to seek
+            if not stream.seekable():
+                return func.HttpResponse("Parquet uploads need a seekable file_data.\n", status_code=400)
+            header = [h.lower() for h in _parquet_header(stream)]
+        else:
+            # a compressed block can be larger than the first chunk, keep reading until we have the header
+            while (file_format != "csv" and b"\n" not in _decompress_head(first_chunk, file_format)
+                   and len(first_chunk) < COMPRESSED_HEADER_MAX_BYTES):
+                more = stream.read(HEADER_SNIFF_BYTES)
+                if not more:
+                    break
+                first_chunk += more
+            header = [h.lower() for h in _sniff_header(_decompress_head(first_chunk, file_format))]
+        stream = _rewind(stream, first_chunk)
 
-        file_url = await _upload_to_blob(binary_filedata, file_name)
+        file_url = await _upload_to_blob(stream, file_name)
 
         messagejson = {
             "file_name": file_name,
-            "table_name": file_name.replace(".", "_").lower(),
+            "file_format": file_format,
+            "table_name": _table_name_for_file(file_name),
             "timestamp": datetime.now().isoformat(),
             "header": header,
             "file_description": file_description,
@@ -58,6 +84,7 @@ async def upload_data(req: func.HttpRequest, message: func.Out[str]) -> func.Htt
         return func.HttpResponse(f"Error processing request. {e} \n", status_code=500)
 
 # accept a file with just header and first line and send a message to service bus about the file with extra metadata, context, and content 
+# json bodies can carry a batch of rows ("rows" instead of "row"), they still end up as a single message
 #TODO make this async
 @app.function_name(name="upload_data_single")
 @app.route(route="upload_data_single", methods=[func.HttpMethod.POST])
@@ -69,20 +96,113 @@ async def upload_data_single(req: func.HttpRequest, message: func.Out[str]) -> f
         # Extract input data from the request
         logging.info(f"Executing upload_data_single.")
 
-        message.set(req.get_body().decode('utf-8'))
+        body = req.get_body()
+        if len(body) > SINGLE_LINE_MAX_BODY_BYTES:
+            return func.HttpResponse(f"Request body exceeds {SINGLE_LINE_MAX_BODY_BYTES} bytes, send smaller batches.\n", status_code=413)
+        body = body.decode('utf-8')
 
-        return func.HttpResponse(f"upload_data_single processed and added to the queue.\n", status_code=200)
+        num_rows = 1
+        if body.lstrip().startswith("{"):
+            event = json.loads(body)
+            if "rows" in event:
+                if not isinstance(event["rows"], list):
+                    return func.HttpResponse("rows has to be a list of rows.\n", status_code=400)
+                num_rows = len(event["rows"])
+            elif "row" not in event:
+                return func.HttpResponse("Missing row or rows in the request.\n", status_code=400)
+
+        message.set(body)
+
+        return func.HttpResponse(f"upload_data_single processed {num_rows} rows and added them to the queue.\n", status_code=200)
 
     except Exception as e:
         logging.error(f"Error processing request: {e}")
         return func.HttpResponse(f"Error processing request. {e} \n", status_code=500)
 
 
-#TODO make this async
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+PARQUET_MAGIC = b"PAR1"
+COMPRESSED_EXTENSIONS = {".gz": "gzip", ".gzip": "gzip", ".zst": "zstd", ".zstd": "zstd"}
+
+
+# csv, gzip (compressed csv), zstd (compressed csv) or parquet, by magic bytes first and extension second
+# (same rules as detect_format in the ingest function app)
+def _detect_format(file_name, head):
+    if head.startswith(GZIP_MAGIC):
+        return "gzip"
+    if head.startswith(ZSTD_MAGIC):
+        return "zstd"
+    if head.startswith(PARQUET_MAGIC):
+        return "parquet"
+    lower = file_name.lower()
+    if lower.endswith(".parquet"):
+        return "parquet"
+    for extension, file_format in COMPRESSED_EXTENSIONS.items():
+        if lower.endswith(extension):
+            return file_format
+    return "csv"
+
+
+# compressed csv lands in the same table as the plain file would
+def _table_name_for_file(file_name):
+    for extension in COMPRESSED_EXTENSIONS:
+        if file_name.lower().endswith(extension):
+            file_name = file_name[:-len(extension)]
+            break
+    return file_name.replace(".", "_").lower()
+
+
+# decompress as much of the first chunk as we can, enough to get to the header
+def _decompress_head(first_chunk, file_format):
+    if file_format == "gzip":
+        return zlib.decompressobj(wbits=31).decompress(first_chunk)
+    if file_format == "zstd":
+        # only needed for zstd uploads
+        import zstandard
+        return zstandard.ZstdDecompressor().decompressobj().decompress(first_chunk)
+    return first_chunk
+
+
+def _parquet_header(stream):
+    # only needed for parquet uploads, reads the footer and leaves the data alone
+    import pyarrow.parquet as pq
+    return pq.ParquetFile(stream).schema_arrow.names
+
+
+# parse the header row out of the first chunk of the file
+def _sniff_header(first_chunk):
+    header_end = first_chunk.find(b"\n")
+    if header_end < 0 and len(first_chunk) >= HEADER_SNIFF_BYTES:
+        raise ValueError(f"No header row found in the first {HEADER_SNIFF_BYTES} bytes")
+    header_line = first_chunk[:header_end] if header_end >= 0 else first_chunk
+    header = next(csv.reader([header_line.decode("utf-8-sig").rstrip("\r")]), [])
+    if not header:
+        raise ValueError("No header row found")
+    return header
+
+
+# go back to the start of the file, without buffering it if the stream can't seek
+def _rewind(stream, first_chunk):
+    if stream.seekable():
+        stream.seek(0)
+        return stream
+    return _iter_chunks(first_chunk, stream)
+
+
+def _iter_chunks(first_chunk, stream):
+    yield first_chunk
+    while True:
+        chunk = stream.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
 async def _upload_to_blob(file_data, file_name):
     try:
         blob_client = container_client.get_blob_client(file_name)
-        await blob_client.upload_blob(file_data, overwrite=True)
+        await blob_client.upload_blob(file_data, overwrite=True, max_concurrency=UPLOAD_MAX_CONCURRENCY)
         return blob_client.url
     except Exception as e:
         logging.error(f"Error uploading file {file_name} to Azure Blob Storage: {e}")
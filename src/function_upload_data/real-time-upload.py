@@ -1,37 +1,124 @@
 #!/usr/bin/env python
 
 import csv
-import requests
+import time
+import random
+import asyncio
 import argparse
+import aiohttp
 
 
-# TODO: we still need to figure out whether or not we want to actually 
+# TODO: we still need to figure out whether or not we want to actually
 #       enter these rows into the DB or not
 
-def upload_file(file_name, file_description, target_url):
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+# group the csv rows into the request bodies, one row per request unless we batch
+def build_payloads(file_name, file_description, batch_size):
     with open(file_name, 'r') as file:
         reader = csv.DictReader(file)
         headers = reader.fieldnames
-        
+        batch = []
         for row in reader:
-            data = {
-                "file_name": file_name,
-                "file_description": file_description,
-                "headers": headers,
-                "row": row
-            }
-            print(row)
-            response = requests.post(target_url, json=data)
-            if response.status_code != 200:
-                print(f"Failed to upload row: {row}")
-            else:
-                print(f"Successfully uploaded row: {row}")
+            if batch_size <= 1:
+                yield 1, {
+                    "file_name": file_name,
+                    "file_description": file_description,
+                    "headers": headers,
+                    "row": row
+                }
+                continue
+            batch.append(row)
+            if len(batch) >= batch_size:
+                yield len(batch), {"file_name": file_name, "file_description": file_description, "headers": headers, "rows": batch}
+                batch = []
+        if batch:
+            yield len(batch), {"file_name": file_name, "file_description": file_description, "headers": headers, "rows": batch}
+
+
+# post one payload, retrying throttling and server errors with exponential backoff and full jitter
+async def post_payload(session, target_url, payload, retries, backoff):
+    for attempt in range(retries + 1):
+        try:
+            async with session.post(target_url, json=payload) as response:
+                await response.read()
+                if response.status == 200:
+                    return True
+                if response.status not in RETRY_STATUS_CODES:
+                    return False
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            pass
+        if attempt < retries:
+            await asyncio.sleep(random.uniform(0, backoff * 2 ** attempt))
+    return False
+
+
+async def worker(queue, session, target_url, stats, args):
+    while True:
+        item = await queue.get()
+        if item is None:
+            queue.task_done()
+            return
+        num_rows, payload = item
+        start = time.perf_counter()
+        ok = await post_payload(session, target_url, payload, args.retries, args.backoff)
+        stats["latencies"].append(time.perf_counter() - start)
+        stats["requests"] += 1
+        if ok:
+            stats["rows"] += num_rows
+            if args.verbose:
+                print(f"Successfully uploaded {num_rows} rows")
+        else:
+            stats["failed_rows"] += num_rows
+            print(f"Failed to upload {num_rows} rows: {payload.get('row') or payload['rows'][0]}...")
+        queue.task_done()
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def upload_file(file_name, file_description, target_url, args):
+    stats = {"rows": 0, "failed_rows": 0, "requests": 0, "latencies": []}
+    # bounded queue so we never read much more of the file than is in flight
+    queue = asyncio.Queue(maxsize=args.concurrency * 2)
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    start = time.perf_counter()
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        workers = [asyncio.create_task(worker(queue, session, target_url, stats, args)) for _ in range(args.concurrency)]
+        for item in build_payloads(file_name, file_description, args.batch_size):
+            await queue.put(item)
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    elapsed = time.perf_counter() - start
+
+    latencies = stats["latencies"]
+    print(f"Uploaded {stats['rows']} rows ({stats['failed_rows']} failed) in {stats['requests']} requests and {elapsed:.2f}s")
+    print(f"Throughput: {stats['rows'] / elapsed:.1f} rows/s, {stats['requests'] / elapsed:.1f} requests/s")
+    print(f"Latency: p50 {percentile(latencies, 0.50) * 1000:.0f}ms, "
+          f"p95 {percentile(latencies, 0.95) * 1000:.0f}ms, "
+          f"p99 {percentile(latencies, 0.99) * 1000:.0f}ms, "
+          f"max {max(latencies, default=0.0) * 1000:.0f}ms")
+    return stats
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Upload CSV data to a target URL.')
     parser.add_argument('file_name', type=str, help='The name of the file to upload')
     parser.add_argument('file_description', type=str, help='A description of the file')
     parser.add_argument('target_url', type=str, help='The target URL to upload the data to')
+    parser.add_argument('--concurrency', type=int, default=16, help='Number of requests in flight')
+    parser.add_argument('--batch-size', type=int, default=1, help='Rows per request, more than 1 sends them as a batch')
+    parser.add_argument('--retries', type=int, default=3, help='Retries per request on errors and throttling')
+    parser.add_argument('--backoff', type=float, default=0.5, help='Base backoff in seconds, doubled per retry')
+    parser.add_argument('--timeout', type=float, default=30, help='Timeout per request in seconds')
+    parser.add_argument('--verbose', action='store_true', help='Print every successful request')
 
     args = parser.parse_args()
-    upload_file(args.file_name, args.file_description, args.target_url)
\ No newline at end of file
+    asyncio.run(upload_file(args.file_name, args.file_description, args.target_url, args))